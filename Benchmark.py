@@ -0,0 +1,145 @@
+import argparse
+import glob
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from OWScript import Errors
+from OWScript.Lexer import Lexer
+from OWScript.Optimizer import CommonValues
+from OWScript.Parser import Parser
+from OWScript.Workshop import WorkshopData
+
+def parse_expr(tokens):
+    """Parses a single expression from the given tokens."""
+    parser = Parser(tokens=iter(tokens))
+    return parser.expr()
+
+def bench_parser(args):
+    """Times the expression parser on literals, operator chains and a mix of every precedence level."""
+    cases = {
+        'literal': '1',
+        'arithmetic': '1 + 2 * 3 - 4 / 5 ^ 6 % 7',
+        'logic': 'not A == 1 and B != 2 or C < 3 and D in E',
+        'sum chain': ' + '.join(['1'] * args.size),
+        'compare chain': ' < '.join(['1'] * args.size),
+        'not chain': 'not ' * args.size + 'A'
+    }
+    for name, text in cases.items():
+        Errors.TEXT = text
+        tokens = Lexer(text=text + '\n').lex()
+        try:
+            times = timeit.repeat(lambda: parse_expr(tokens), number=args.number, repeat=args.repeat)
+        except RecursionError:
+            print('{:<14} RecursionError'.format(name))
+            continue
+        best = min(times) / args.number
+        print('{:<14} {:>6} tokens {:>10.1f} us/parse {:>8.0f} ns/token'.format(name, len(tokens), best * 1e6, best * 1e9 / len(tokens)))
+
+def run(*command):
+    """Runs a Python command in a new interpreter and returns the wall time it took."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + list(command), stdout=subprocess.DEVNULL, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return time.perf_counter() - start
+
+def bench_startup(args):
+    """Times `python OWScript.py` runs on a one-line script against a bare interpreter start. The
+    'no cache' case removes the Workshop.json cache before each run, the 'cache' case reuses it."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'startup.owpy')
+        with open(path, 'w') as f:
+            f.write('value = 1\n')
+        def uncached():
+            for cache in glob.glob(WorkshopData.CACHE.format('*')):
+                os.remove(cache)
+            return run('OWScript.py', path)
+        cases = {
+            'interpreter': lambda: run('-c', 'pass'),
+            'no cache': uncached,
+            'cache': lambda: run('OWScript.py', path)
+        }
+        baseline = None
+        for name, func in cases.items():
+            times = [func() for _ in range(args.repeat)]
+            median = statistics.median(times)
+            if baseline is None:
+                baseline = median
+            print('{:<14} median {:>7.1f}ms  min {:>7.1f}ms  (+{:.1f}ms)'.format(name, median * 1e3, min(times) * 1e3, (median - baseline) * 1e3))
+
+def bench_relex(args):
+    """Times a full lex against a relex after a one-line edit in the middle of a script of `--size` rules.
+    The relexed tokens must match a full lex of the edited script, and lexing must stop at the next rule.
+    A parse error in the middle of the script must be reported on its line while the tokens are streamed."""
+    rule = 'Rule "Rule {0}"\n    Event\n        On Global\n    Actions\n        value{0} = {0}\n        Msg(Everyone, value{0})\n\n'
+    text = ''.join(rule.format(index) for index in range(args.size))
+    lines = text.split('\n')
+    line = rule.count('\n') * (args.size // 2) + 5
+    edited = '\n'.join(lines[:line - 1] + [lines[line - 1] + ' + 1'] + lines[line:])
+    tokens = Lexer(text=text).lex()
+    old = set(map(id, tokens))
+    relexed = Lexer(text=edited).relex(tokens, line, line)
+    lexed = len([token for token in relexed if id(token) not in old])
+    expected = Lexer(text=edited).lex()
+    if [(token.type, token.value, token.pos) for token in relexed] != [(token.type, token.value, token.pos) for token in expected]:
+        sys.exit('relex: tokens differ from a full lex')
+    if lexed > len(expected) // args.size * 2:
+        sys.exit('relex: {} of {} tokens lexed again, the lexer did not resynchronize'.format(lexed, len(expected)))
+    # Errors raised while the parser streams the tokens must be located before the lexer reaches the next rule
+    broken = '\n'.join(lines[:line - 1] + ['        value = (1 +'] + lines[line:])
+    try:
+        Parser(tokens=Lexer(text=broken).tokenize()).script()
+        sys.exit('relex: the unclosed parenthesis on line {} was not reported'.format(line))
+    except Errors.ParseError as ex:
+        if not str(ex).startswith('Line {}\n        value = (1 +\n'.format(line)):
+            sys.exit('relex: parse error on line {} reported as:\n{}'.format(line, ex))
+    texts = [text, edited]
+    def relex():
+        texts.reverse()
+        Lexer(text=texts[0]).relex(tokens, line, line)
+    cases = {
+        'full lex': lambda: Lexer(text=edited).lex(),
+        'relex': relex
+    }
+    for name, func in cases.items():
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat * 4))
+        print('{:<14} {:>6} tokens {:>10.1f} us/run'.format(name, len(expected) if name == 'full lex' else lexed, best * 1e6))
+
+def bench_cse(args):
+    """Times the common value pass on a run of `--size` actions which compute the same values. The values in
+    the conditions and ranks of array values (evaluated for each element) must be left in place."""
+    distance = 'Distance Between(Position Of(Current Array Element), Eye Position(First Of(All Players(Team(All)))))'
+    callbacks = [
+        'Set Global Variable At Index(A, 1, Sorted Array(All Players(Team(All)), {}))'.format(distance),
+        'Set Global Variable At Index(A, 2, Filtered Array(All Living Players(Team(All)), Compare({}, <, 10)))'.format(distance),
+        'Set Global Variable At Index(A, 3, Sorted Array(All Dead Players(Team(All)), {}))'.format(distance)
+    ]
+    if CommonValues(temp=lambda index: 10 + index).optimize(callbacks) != callbacks:
+        sys.exit('cse: a value evaluated for each array element was shared')
+    actions = ['Small Message(All Players(Team(All)), Add(Distance Between(Eye Position(Event Player), Position Of(First Of(All Players(Team(All))))), {}))'.format(index)
+        for index in range(args.size)]
+    best = min(timeit.repeat(lambda: CommonValues(temp=lambda index: 10 + index).optimize(actions), number=1, repeat=args.repeat))
+    print('{:<14} {:>6} actions {:>9.1f} us/run'.format('shared', len(actions), best * 1e6))
+
+BENCHMARKS = {
+    'parser': bench_parser,
+    'startup': bench_startup,
+    'relex': bench_relex,
+    'cse': bench_cse
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the OWScript compiler stages')
+    parser.add_argument('benchmarks', nargs='*', help='Benchmarks to run ({}), blank for all'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('-n', '--number', type=int, default=200, help='Runs per timing')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Timings per case (the best one is reported)')
+    parser.add_argument('--size', type=int, default=2000, help='Number of operators in the chained cases, of rules in the relex script and of actions in the cse run')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark \'{}\''.format(name))
+    for name in args.benchmarks or BENCHMARKS:
+        print('[{}]'.format(name))
+        BENCHMARKS[name](args)
@@ -1,4 +1,5 @@
 import argparse
+import json
 import os
 import re
 import sys
@@ -14,8 +15,9 @@ def transpile(text, path, args):
     start = time.time()
     Errors.TEXT = text
     lexer = Lexer(text=text + '\n')
-    tokens = lexer.lex()
+    tokens = lexer.tokenize()
     if args.tokens:
+        tokens = lexer.lex()
         if args.save:
             with open(args.save, 'w', errors='ignore') as f:
                 f.write(lexer.print_tokens())
@@ -26,7 +28,14 @@ def transpile(text, path, args):
     if args.tree:
         print(tree.string())
     logger = Logger(log_level=args.debug)
-    transpiler = Transpiler(tree=tree, path=path, logger=logger, credit=args.no_credit)
+    profile = None
+    if args.profile:
+        try:
+            with open(args.profile) as f:
+                profile = json.load(f)
+        except FileNotFoundError:
+            raise Errors.FileNotFoundError('Profile file not found.')
+    transpiler = Transpiler(tree=tree, path=path, logger=logger, credit=args.no_credit, optimize=args.optimize, unroll_limit=args.unroll, unroll_copies=args.unroll_copies, profile=profile)
     code = transpiler.run()
     if args.min:
         code = re.sub(r'[\s\n]*', '', code)
@@ -62,6 +71,10 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--copy', action='store_true', help='Copies output to clipboard automatically')
     parser.add_argument('-t', '--time', action='store_true', help='Debug: outputs the time elapsed to generate the output')
     parser.add_argument('-d', '--debug', type=int, default=Logger.WARN, help='The severity level of the logger (1=Info, 2=Warning, 3=Debug)')
+    parser.add_argument('-O', '--optimize', action='append', default=[], choices=Transpiler.OPTIMIZATIONS, help='Enables an optimization pass (can be repeated)')
+    parser.add_argument('-u', '--unroll', type=int, default=Transpiler.UNROLL_LIMIT, help='The number of actions up to which for loops are unrolled')
+    parser.add_argument('--unroll-copies', type=int, default=Transpiler.UNROLL_COPIES, help='The most copies of the body of a for loop over a workshop array per iteration')
+    parser.add_argument('-p', '--profile', help='A JSON file of the number of uses of each variable by name, which ranks the variables for `-O letters`')
     parser.add_argument('--no-credit', action='store_true', help='Author credit rule is not generated in the output')
     parser.add_argument('--tokens', action='store_true', help='Debug: shows the tokens created by the lexer')
     parser.add_argument('--tree', action='store_true', help='Debug: visualizes the AST generated by the parser')
@@ -1,3 +1,5 @@
+import math
+
 class AST:
     children = []
     def __init__(self):
@@ -98,6 +100,15 @@ class WorkshopType(AST):
     def get_values(cls):
         return cls._values + [x().get_values() for x in cls._extends]
 
+    @classmethod
+    def value_set(cls):
+        """Returns the frozenset of values accepted by the type and the types it extends (without commas), computed on first use."""
+        values = cls.__dict__.get('_value_set')
+        if values is None:
+            values = frozenset(value.replace(',', '') for value in cls._values).union(*(x.value_set() for x in cls._extends))
+            cls._value_set = values
+        return values
+
     def __repr__(self):
         try:
             return self.__name__
@@ -289,7 +300,11 @@ class Number(WorkshopType):
         return float(self.value) ** float(other.value)
 
     def __mod__(self, other):
-        return float(self.value) % float(other.value)
+        # The workshop's modulo takes the sign of the dividend
+        divisor = float(other.value)
+        if not divisor:
+            raise ZeroDivisionError('modulo by zero')
+        return math.fmod(float(self.value), divisor)
 
     def __repr__(self):
         return '{}'.format(self.value)
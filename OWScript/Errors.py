@@ -1,6 +1,107 @@
 import sys
+from bisect import bisect_right
+from itertools import accumulate
 TEXT = None
 
+class Block:
+    """A run of lines of a source text, from offset `pos` (the start of line `line`) up to the next block.
+    Line starts and the tokens of a block are stored relative to `pos`, so that an edit before the block
+    only moves the block."""
+    __slots__ = ('pos', 'line', 'starts', 'lines')
+    def __init__(self, pos, line, lines):
+        self.pos = pos
+        self.line = line
+        self.lines = lines
+        # Offsets of the lines from the start of the block, filled in as the lexer scans its line breaks
+        self.starts = [0]
+
+class LineIndex:
+    """Start offsets of every line of a source text, built once and shared by its tokens and errors. The
+    lines are grouped in blocks, one for the whole text unless the lexer splits it."""
+    def __init__(self, text, blocks=None):
+        self.text = text
+        if blocks is None:
+            block = Block(0, 1, self)
+            # Each line starts one character (the line break) after the end of the previous one
+            block.starts.extend(accumulate(len(line) + 1 for line in text.split('\n')))
+            block.starts.pop()
+            blocks = [block]
+        self.blocks = blocks
+
+    def scan(self, block, start, end):
+        """Adds the starts of the lines after the line breaks between offsets `start` and `end` to a block."""
+        starts = block.starts
+        pos = self.text.find('\n', start, end)
+        while pos != -1:
+            starts.append(pos + 1 - block.pos)
+            pos = self.text.find('\n', pos + 1, end)
+
+    def splice(self, first, last, blocks, shift, lines):
+        """Replaces blocks `first` to `last` (excluded) with new ones, after an edit which changed the length
+        of the text by `shift` and the number of lines by `lines`. Only the later blocks are moved."""
+        self.blocks[first:last] = blocks
+        if shift or lines:
+            for block in self.blocks[first + len(blocks):]:
+                block.pos += shift
+                block.line += lines
+
+    def find(self, pos):
+        """Returns the index of the block of an offset."""
+        lo, hi = 1, len(self.blocks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.blocks[mid].pos <= pos:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo - 1
+
+    def find_line(self, line):
+        """Returns the block of a line number."""
+        lo, hi = 1, len(self.blocks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.blocks[mid].line <= line:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.blocks[lo - 1]
+
+    def start(self, line):
+        """Returns the offset of the start of a line, or the length of the text after the last line."""
+        block = self.find_line(line)
+        if line - block.line >= len(block.starts):
+            return len(self.text)
+        return block.pos + block.starts[line - block.line]
+
+    def line(self, pos):
+        """Returns the line number (starting from 1) of an offset."""
+        block = self.blocks[self.find(pos)]
+        return block.line + bisect_right(block.starts, pos - block.pos) - 1
+
+    def position(self, pos):
+        """Returns the tuple (line, column) of an offset, with tabs counted as 4 columns."""
+        block = self.blocks[self.find(pos)]
+        index = bisect_right(block.starts, pos - block.pos) - 1
+        start = block.pos + block.starts[index]
+        return block.line + index, len(self.text[start:pos].replace('\t', ' ' * 4)) + 1
+
+    def line_text(self, line):
+        """Returns the text of a line without its line break."""
+        start = self.start(line)
+        end = self.text.find('\n', start)
+        return self.text[start:end if end != -1 else len(self.text)]
+
+class Location:
+    """An offset in a source text which unpacks to (line, column) when it is displayed."""
+    __slots__ = ('pos', 'lines')
+    def __init__(self, pos, lines):
+        self.pos = pos
+        self.lines = lines
+
+    def __iter__(self):
+        return iter(self.lines.position(self.pos))
+
 class ExitCode:
     CompileError = 1
     InputNotFound = 2
@@ -27,10 +128,10 @@ class Logger:
 
 class OWSError(Exception):
     def __init__(self, msg, pos=None):
-        global TEXT
         if pos:
             line, col = pos
-            text = '\n' + TEXT.split('\n')[line - 1].replace('\t', ' ' * 4)
+            text = pos.lines.line_text(line) if isinstance(pos, Location) else TEXT.split('\n')[line - 1]
+            text = '\n' + text.replace('\t', ' ' * 4)
             char = '\n' + ' ' * (col - 1) + '^\n'
             msg = 'Line {}'.format(line) + text + char + msg
         super().__init__(msg)
@@ -6,7 +6,7 @@ def import_file(path):
         text = f.read() + '\n'
     try:
         lexer = Lexer(text=text)
-        tokens = lexer.lex()
+        tokens = lexer.tokenize()
         parser = Parser(tokens=tokens)
         tree = parser.script()
         return tree
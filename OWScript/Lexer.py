@@ -1,20 +1,74 @@
 import functools
 import re
+import sys
 
 from . import Errors
 from .Tokens import Token, Tokens
 
+class PatternScanner:
+    """Matches a run of token patterns, in priority order, with a single combined expression.
+    Tokens with a delimited matcher only contribute their opening pattern; the matcher then finds the end."""
+    def __init__(self, patterns, matchers={}):
+        self.regex = re.compile('|'.join('(?P<{}>{})'.format(token, pattern) for token, pattern in patterns), re.I)
+        # Token types are shared (interned) strings looked up by group index
+        self.types = {index: sys.intern(token) for token, index in self.regex.groupindex.items()}
+        self.matchers = {self.regex.groupindex[token]: matcher for token, matcher in matchers.items()}
+
+    def __call__(self, text, pos):
+        match = self.regex.match(text, pos)
+        if match:
+            index = match.lastindex
+            matcher = self.matchers.get(index)
+            if matcher is not None:
+                return self.types[index], matcher.match(text, pos)
+            return self.types[index], match.group(index)
+
+class MatcherScanner:
+    """Matches a token whose values are found by a dedicated matcher, such as a keyword trie."""
+    def __init__(self, token, matcher):
+        self.token = sys.intern(token)
+        self.matcher = matcher
+
+    def __call__(self, text, pos):
+        value = self.matcher.match(text, pos)
+        if value is not None:
+            return self.token, value
+
+def scanners(tokens):
+    """Groups consecutive token patterns into combined scanners, keeping the token priority order."""
+    result = []
+    patterns = []
+    matchers = {}
+    for token, pattern in tokens.items():
+        if isinstance(pattern, str):
+            patterns.append((token, pattern))
+        elif hasattr(pattern, 'start'):
+            patterns.append((token, pattern.start))
+            matchers[token] = pattern
+        else:
+            if patterns:
+                result.append(PatternScanner(patterns, matchers))
+                patterns = []
+                matchers = {}
+            result.append(MatcherScanner(token, pattern))
+    if patterns:
+        result.append(PatternScanner(patterns, matchers))
+    return result
+
 class Lexer:
-    IGNORE = ('WHITESPACE', 'SEMI', 'COMMENT', 'ANNOTATION')
+    IGNORE = frozenset(('WHITESPACE', 'SEMI', 'COMMENT', 'ANNOTATION'))
     NEWLINE = functools.partial(Token, type='NEWLINE', value='\n')
     INDENT = functools.partial(Token, type='INDENT', value='⮡')
     DEDENT = functools.partial(Token, type='DEDENT', value='⮢')
     EOF = functools.partial(Token, type='EOF', value='')
+    SCANNERS = scanners(Tokens.__annotations__)
+    WHITESPACE = re.compile(Tokens.__annotations__.get('WHITESPACE'))
     def __init__(self, text):
         self.text = text
+        # The blocks of lines are added by tokenize
+        self.lines = Errors.LineIndex(text, blocks=[])
+        self.blocks = self.lines.blocks
         self.pos = 0
-        self.line = 1
-        self.column = 1
         self.indents = []
         self.tokens = []
 
@@ -26,53 +80,113 @@ class Lexer:
 
     def lex(self):
         """Tokenizes input into a list of tokens."""
-        expressions = [(token, re.compile(pattern, re.I)) for token, pattern in Tokens.__annotations__.items()]
-        whitespace_pattern = re.compile(Tokens.__annotations__.get('WHITESPACE'))
+        self.tokens.extend(self.tokenize())
+        return self.tokens
+
+    @staticmethod
+    def find_offset(tokens, pos, lo=0):
+        """Returns the index of the first token at or after offset `pos` (binary search)."""
+        hi = len(tokens)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tokens[mid].pos < pos:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def relex(self, tokens, first_line, last_line):
+        """Updates the token list of the previous text after lines `first_line` to `last_line` of it were
+        replaced. Lexing restarts at the block of lines before the edit and stops as soon as a new block
+        lines up with an old one again. The blocks in between are replaced in the line index shared by the
+        tokens, and the later blocks are moved along with their tokens."""
+        if not tokens:
+            self.tokens = tokens
+            return self.lex()
+        lines = tokens[0].lines
+        old_text = lines.text
+        begin = lines.start(first_line)
+        end = lines.start(last_line + 1)
+        shift = len(self.text) - len(old_text)
+        # The dedents at the end of the block before the edit depend on the indent of the edited lines
+        first = lines.find(begin - 1) if begin else 0
+        block = lines.blocks[first]
+        start = Lexer.find_offset(tokens, block.pos)
+        while tokens[start].block is not block:
+            start += 1
+        lines.text = self.text
+        self.lines = lines
+        self.blocks = []
+        self.pos = block.pos
+        self.indents = []
+        old = Lexer.find_offset(tokens, end, start)
+        new = []
+        for token in self.tokenize(block.line):
+            if new and token.block is not new[-1].block and token.pos - shift >= end:
+                old = Lexer.find_offset(tokens, token.pos - shift, old)
+                # The dedents closing the previous block share the offset of the first token of the block
+                while old < len(tokens) and tokens[old].type == 'DEDENT' and tokens[old].pos == token.pos - shift:
+                    old += 1
+                if old < len(tokens) and tokens[old].pos == token.pos - shift and tokens[old].block is not tokens[old - 1].block \
+                    and tokens[old].type == token.type and tokens[old].value == token.value:
+                    break
+            new.append(token)
+        else:
+            old = len(tokens)
+        if old < len(tokens):
+            # The block started at the token which lines up is the old one
+            blocks = self.blocks[:-1]
+            last = lines.find(tokens[old].block.pos)
+        else:
+            blocks = self.blocks
+            last = len(lines.blocks)
+        tokens[start:old] = new
+        lines.splice(first, last, blocks, shift, self.text.count('\n', begin, end + shift) - old_text.count('\n', begin, end))
+        self.tokens = tokens
+        return tokens
+
+    def tokenize(self, line=1):
+        """Generates tokens from the input one at a time, as the parser requests them. A block of lines starts
+        at each token at the start of an unindented line, where lexing can restart. The line starts are added
+        to the index as the line breaks are scanned, so that errors raised while parsing can be located."""
+        whitespace_pattern = Lexer.WHITESPACE
+        block = Errors.Block(self.pos, line, self.lines)
+        self.blocks.append(block)
         self.indents.append(0)
         while self.pos < len(self.text):
-            for token_type, pattern in expressions:
-                match = pattern.match(self.text, self.pos)
-                if match:
-                    value = match.group(1) if token_type == 'OWID' else match.group(0)
-                    token = Token(type=token_type, value=value, line=self.line, column=self.column)
-                    if value:
-                        self.pos += len(value)
-                    if token.type == 'NEWLINE':
-                        token.value = r'\n'
-                        self.tokens.append(token)
-                        self.line += match.group(0).count('\n')
-                        match = whitespace_pattern.match(self.text, self.pos)
-                        self.column = len(match.group(0).replace('\t', ' ' * 4)) + 1 if match else 1
-                        spaces = self.column - 1
-                        if spaces > self.indents[-1]:
-                            indent = Lexer.INDENT(line=self.line, column=self.column)
-                            self.tokens.append(indent)
-                            self.indents.append(spaces)
-                        elif spaces < self.indents[-1]:
-                            while spaces < self.indents[-1]:
-                                self.indents.pop()
-                                self.column = spaces + 1
-                                dedent = Lexer.DEDENT(line=self.line, column=self.column)
-                                self.tokens.append(dedent)
-                        else:
-                            self.column = spaces + 1
-                        if match:
-                            self.pos = match.end()
-                        break
-                    elif token.type in Lexer.IGNORE:
-                        self.column += len(token.value)
-                        self.line += token.value.count('\n')
-                        break
-                    else:
-                        self.tokens.append(token)
-                    self.column += len(token.value)
+            for scanner in Lexer.SCANNERS:
+                result = scanner(self.text, self.pos)
+                if result:
                     break
             else:
-                Errors.POS = (self.line, self.column)
-                raise Errors.LexError("Unexpected symbol '{}'".format(self.text[self.pos]))
+                raise Errors.LexError("Unexpected symbol '{}'".format(self.text[self.pos]), pos=Errors.Location(self.pos, Errors.LineIndex(self.text)))
+            token_type, value = result
+            if token_type == 'NEWLINE':
+                yield Token(type=token_type, value=r'\n', offset=self.pos - block.pos, block=block)
+                self.lines.scan(block, self.pos, self.pos + len(value))
+                self.pos += len(value)
+                match = whitespace_pattern.match(self.text, self.pos)
+                spaces = len(match.group(0).replace('\t', ' ' * 4)) if match else 0
+                if match:
+                    self.pos = match.end()
+                if spaces > self.indents[-1]:
+                    yield Lexer.INDENT(offset=self.pos - block.pos, block=block)
+                    self.indents.append(spaces)
+                while spaces < self.indents[-1]:
+                    self.indents.pop()
+                    yield Lexer.DEDENT(offset=self.pos - block.pos, block=block)
+                continue
+            elif token_type not in Lexer.IGNORE:
+                if self.pos != block.pos and self.text[self.pos - 1] == '\n':
+                    # The line starting at the token is the first line of the new block
+                    block.starts.pop()
+                    block = Errors.Block(self.pos, block.line + len(block.starts), self.lines)
+                    self.blocks.append(block)
+                yield Token(type=token_type, value=value, offset=self.pos - block.pos, block=block)
+            if '\n' in value:
+                self.lines.scan(block, self.pos, self.pos + len(value))
+            self.pos += len(value)
         while self.indents[-1] > 0:
-            self.column = self.indents.pop()
-            dedent = Lexer.DEDENT(line=self.line, column=self.column)
-            self.tokens.append(dedent)
-        self.tokens.append(Lexer.EOF(line=self.line, column=0))
-        return self.tokens
\ No newline at end of file
+            self.indents.pop()
+            yield Lexer.DEDENT(offset=self.pos - block.pos, block=block)
+        yield Lexer.EOF(offset=self.pos - block.pos, block=block)
@@ -0,0 +1,966 @@
+import decimal
+import math
+import re
+
+from .AST import Var
+
+class Value:
+    """A workshop value with arguments parsed from generated code, such as `Add(Position Of(Event Player), 1)`.
+    Its text is the slice `code[start:end]` of the code it was parsed from. Only the arguments which have
+    arguments themselves are kept as values (literals and constants are left in the text), but the spans
+    of all of the arguments are kept."""
+    __slots__ = ('name', 'args', 'spans', 'start', 'end', 'calls', 'parent')
+    # Strings are matched whole, so that the delimiters in them are skipped
+    DELIMITERS = re.compile(r'"[^"]*"|[(),]')
+    def __init__(self, name, args, spans, start, end):
+        self.name = name
+        self.args = args
+        self.spans = spans
+        self.start = start
+        self.end = end
+        # Number of values with arguments in this value, i.e. the values which are computed
+        self.calls = 1 + sum(arg.calls for arg in args)
+        self.parent = None
+        for arg in args:
+            arg.parent = self
+
+    def walk(self):
+        """Yields this value and all of its arguments, recursively."""
+        stack = [self]
+        while stack:
+            value = stack.pop()
+            yield value
+            stack.extend(reversed(value.args))
+
+    @staticmethod
+    def parse(code):
+        """Parses an action or value, or returns None if it is not a value with arguments separated by `, `."""
+        # Values being parsed, as (start, name, args, spans)
+        stack = []
+        start = 0
+        value = None
+        for match in Value.DELIMITERS.finditer(code):
+            pos = match.start()
+            delimiter = code[pos]
+            if delimiter == '"':
+                continue
+            if delimiter == '(':
+                if value is not None:
+                    return None
+                stack.append((start, code[start:pos], [], []))
+                start = pos + 1
+                continue
+            if not stack:
+                return None
+            if value is not None:
+                if pos != value.end:
+                    return None
+                stack[-1][2].append(value)
+                start = value.start
+                value = None
+            stack[-1][3].append((start, pos))
+            if delimiter == ',':
+                if not code.startswith(' ', pos + 1):
+                    return None
+                start = pos + 2
+            else:
+                start, name, args, spans = stack.pop()
+                value = Value(name, args, spans, start, pos + 1)
+                start = pos + 1
+        if stack or value is None or value.end != len(code):
+            return None
+        return value
+
+class CommonValues:
+    """Stores values which are computed more than once in a run of actions in temporary global variables.
+
+    A run ends at jumps, labels and any action which may change the state of the game. Values which read
+    variables are only shared until a variable is modified, and impure values (random, ray casts, times and
+    last created entities) are never shared. Neither are the values of the actions which keep evaluating them
+    (effects, HUD texts, in-world texts and icons), which end a run as well, nor the values in the conditions
+    and ranks evaluated for each element of an array, which depend on the current array element."""
+    IMPURE = re.compile('Random|Ray Cast|Total Time Elapsed|Match Time|Server Load|Last |Current Array ')
+    # Values whose second argument is evaluated for each element of the array in the first one
+    CALLBACKS = ('Filtered Array', 'Sorted Array', 'Mapped Array', 'Is True For Any', 'Is True For All')
+    VARIABLES = re.compile(r'(?:Global|Player) Variable\(')
+    # Actions which only set variables or display something, and leave the values shared across them unchanged
+    WRITES = ('Set Global Variable', 'Set Player Variable', 'Modify Global Variable', 'Modify Player Variable')
+    NEUTRAL = WRITES + ('Small Message', 'Big Message', 'Play Effect')
+    # Actions which keep evaluating their values after they run, which must not read temporaries
+    REEVALUATING = ('Create Hud Text', 'Create In-World Text', 'Create Icon', 'Create Effect')
+    # A temporary is read with `Value In Array(Global Variable(A), i)`, two computed values
+    READ_COST = 2
+    # Smallest value which can be worth sharing (when used often enough)
+    MIN_CALLS = 3
+    def __init__(self, temp):
+        # Returns the global index of the n-th temporary of a run
+        self.temp = temp
+        self.shared = 0
+
+    def optimize(self, actions):
+        """Returns the actions with the common values of each run of actions stored in temporaries."""
+        result = type(actions)()
+        run = []
+        for action in actions:
+            if type(action) == str:
+                run.append(action)
+                if action.startswith(CommonValues.NEUTRAL):
+                    continue
+            result.extend(self.share(run))
+            run = []
+            if type(action) != str:
+                result.append(action)
+        result.extend(self.share(run))
+        return result
+
+    def share(self, run, temp=0):
+        """Shares the common values of a run of actions in which only the last one may change the game state.
+        Values nested in shared ones are shared by repeating this on the result, with the next temporaries."""
+        # Occurrences of each value text, grouped by the variable writes they are separated by
+        occurrences = {}
+        trees = []
+        epoch = 0
+        for action in run:
+            tree = Value.parse(action) if not action.startswith(CommonValues.REEVALUATING) else None
+            trees.append(tree)
+            if tree is not None and tree.calls > CommonValues.MIN_CALLS:
+                for value in tree.walk():
+                    if value is tree or value.calls < CommonValues.MIN_CALLS or CommonValues.callback(value):
+                        continue
+                    text = action[value.start:value.end]
+                    key = (text, epoch if CommonValues.VARIABLES.search(text) else -1)
+                    occurrences.setdefault(key, []).append(value)
+            if action.startswith(CommonValues.WRITES):
+                epoch += 1
+        # Larger values first, so that the values nested in a shared one are not shared again
+        candidates = sorted((item for item in occurrences.items() if len(item[1]) > 1), key=lambda item: -item[1][0].calls)
+        chosen = {}
+        for key, values in candidates:
+            cost = values[0].calls
+            values = [value for value in values if not CommonValues.nested(value, chosen)]
+            uses = len(values)
+            if uses * cost <= cost + 1 + uses * CommonValues.READ_COST or CommonValues.IMPURE.search(key[0]):
+                continue
+            for value in values:
+                chosen[id(value)] = key
+        if not chosen:
+            return run
+        # Temporaries are set right before the first action using them
+        temps = {}
+        result = []
+        for action, tree in zip(run, trees):
+            replaced = []
+            if tree is not None:
+                for value in tree.walk():
+                    key = chosen.get(id(value))
+                    if key is None:
+                        continue
+                    if key not in temps:
+                        temps[key] = self.temp(temp + len(temps))
+                        result.append('Set Global Variable At Index(A, {}, {})'.format(temps[key], key[0]))
+                    replaced.append((value, temps[key]))
+            if replaced:
+                parts = []
+                pos = 0
+                for value, slot in sorted(replaced, key=lambda x: x[0].start):
+                    parts.append(action[pos:value.start])
+                    parts.append('Value In Array(Global Variable(A), {})'.format(slot))
+                    pos = value.end
+                parts.append(action[pos:])
+                action = ''.join(parts)
+            result.append(action)
+        self.shared += len(temps)
+        return self.share(result, temp + len(temps))
+
+    @staticmethod
+    def callback(value):
+        """Whether the value is inside the argument of a value which is evaluated for each array element."""
+        while value.parent is not None:
+            parent = value.parent
+            if parent.name in CommonValues.CALLBACKS and len(parent.spans) > 1 and parent.spans[1][0] == value.start:
+                return True
+            value = parent
+        return False
+
+    @staticmethod
+    def nested(value, chosen):
+        """Whether the value is inside a value which is already shared."""
+        parent = value.parent
+        while parent is not None:
+            if id(parent) in chosen:
+                return True
+            parent = parent.parent
+        return False
+
+class Peephole:
+    """Rewrites short patterns in a list of actions by a table of rules. Skips with literal counts are first
+    turned into jumps to labels (the label and jump types are given by the transpiler), so that the counts of
+    all of the skips are computed after the actions are rewritten."""
+    SKIP = re.compile(r'^(Skip(?: If\(.*, |\())(\d+)\)$')
+    # Operations of `Modify ... Variable At Index` by the value which computes them, and whether they commute
+    MODIFY = {
+        'Add': True,
+        'Subtract': False,
+        'Multiply': True,
+        'Divide': False,
+        'Modulo': False,
+        'Raise To Power': False,
+        'Min': True,
+        'Max': True,
+        'Append To Array': False
+    }
+    RULES = ('double_negation', 'empty_skip', 'waits', 'modify', 'tails')
+    def __init__(self, label, jump):
+        self.label = label
+        self.jump = jump
+        # Number of rewrites and of actions removed by them
+        self.rewrites = 0
+        self.saved = 0
+
+    def optimize(self, actions):
+        """Returns the actions with the rules applied until none of them matches."""
+        actions = self.labels(actions)
+        changed = True
+        while changed:
+            changed = False
+            for rule in Peephole.RULES:
+                result = getattr(self, rule)(actions)
+                if result is not None:
+                    self.saved += sum(type(x) != self.label for x in actions) - sum(type(x) != self.label for x in result)
+                    self.rewrites += 1
+                    actions = result
+                    changed = True
+        return actions
+
+    def labels(self, actions):
+        """Returns the actions with the skips with literal counts replaced by jumps to labels."""
+        positions = [index for index, action in enumerate(actions) if type(action) != self.label]
+        labels = {}
+        result = type(actions)(actions)
+        for number, index in enumerate(positions):
+            match = type(actions[index]) == str and Peephole.SKIP.match(actions[index])
+            if match:
+                target = number + 1 + int(match.group(2))
+                target = positions[target] if target < len(positions) else len(actions)
+                label = labels.setdefault(target, self.label())
+                result[index] = self.jump(match.group(1), label)
+        for target in sorted(labels, reverse=True):
+            result.insert(target, labels[target])
+        return result
+
+    @staticmethod
+    def negated(cond):
+        """Returns x for a condition `Not(Not(x))`, otherwise None."""
+        tree = Value.parse(cond)
+        if tree is None or tree.name != 'Not' or len(tree.spans) != 1 or not tree.args:
+            return None
+        inner = tree.args[0]
+        if inner.name != 'Not' or len(inner.spans) != 1 or tree.spans[0] != (inner.start, inner.end):
+            return None
+        return cond[slice(*inner.spans[0])]
+
+    def double_negation(self, actions):
+        """`Skip If(Not(Not(x)), n)` skips when x is true."""
+        for index, action in enumerate(actions):
+            if type(action) == self.jump and action.prefix.startswith('Skip If(') and action.prefix.endswith(', '):
+                cond = Peephole.negated(action.prefix[len('Skip If('):-len(', ')])
+                if cond is not None:
+                    result = type(actions)(actions)
+                    result[index] = self.jump('Skip If(' + cond + ', ', action.label, action.suffix)
+                    return result
+
+    def empty_skip(self, actions):
+        """A skip over no actions (`Skip(0)`) is removed."""
+        for index, action in enumerate(actions):
+            if type(action) == self.jump:
+                following = index + 1
+                while following < len(actions) and type(actions[following]) == self.label and actions[following] is not action.label:
+                    following += 1
+                if following < len(actions) and actions[following] is action.label:
+                    return type(actions)(actions[:index] + actions[index + 1:])
+
+    def waits(self, actions):
+        """Back-to-back waits which ignore the condition are one wait for the sum of their durations. Waits which
+        abort when the condition changes are kept, since the condition is only checked between them."""
+        for index in range(len(actions) - 1):
+            first, second = actions[index:index + 2]
+            if type(first) != str or type(second) != str or not first.startswith('Wait(') or not second.startswith('Wait('):
+                continue
+            first_tree, second_tree = Value.parse(first), Value.parse(second)
+            if first_tree is None or second_tree is None or len(first_tree.spans) != 2 or len(second_tree.spans) != 2:
+                continue
+            if first[slice(*first_tree.spans[1])] != 'Ignore Condition' or second[slice(*second_tree.spans[1])] != 'Ignore Condition':
+                continue
+            durations = [first[slice(*first_tree.spans[0])], second[slice(*second_tree.spans[0])]]
+            try:
+                duration = ConstantFolder.literal(float(durations[0]) + float(durations[1]))
+            except ValueError:
+                duration = 'Add(' + ', '.join(durations) + ')'
+            wait = 'Wait(' + duration + ', ' + first[slice(*first_tree.spans[1])] + ')'
+            return type(actions)(actions[:index] + [wait] + actions[index + 2:])
+
+    def modify(self, actions):
+        """`Set Global Variable At Index(A, i, Add(Value In Array(Global Variable(A), i), k))` is
+        `Modify Global Variable At Index(A, i, Add, k)`, and likewise for the other operations and player variables."""
+        for index, action in enumerate(actions):
+            if type(action) != str or not action.startswith(('Set Global Variable At Index(', 'Set Player Variable At Index(')):
+                continue
+            tree = Value.parse(action)
+            if tree is None or not tree.args or tree.args[-1].end != tree.spans[-1][1] or tree.args[-1].start != tree.spans[-1][0]:
+                continue
+            value = tree.args[-1]
+            commutes = Peephole.MODIFY.get(value.name)
+            if commutes is None or len(value.spans) != 2:
+                continue
+            target = ', '.join(action[slice(*span)] for span in tree.spans[:-1])
+            if tree.name.startswith('Set Global'):
+                read = 'Value In Array(Global Variable({}), {})'.format(*(action[slice(*span)] for span in tree.spans[:2]))
+            else:
+                read = 'Value In Array(Player Variable({}, {}), {})'.format(*(action[slice(*span)] for span in tree.spans[:3]))
+            operands = [action[slice(*span)] for span in value.spans]
+            if operands[0] == read:
+                operand = operands[1]
+            elif commutes and operands[1] == read:
+                operand = operands[0]
+            else:
+                continue
+            modify = 'Modify' + tree.name[len('Set'):] + '(' + target + ', ' + value.name + ', ' + operand + ')'
+            return type(actions)(actions[:index] + [modify] + actions[index + 1:])
+
+    def tails(self, actions):
+        """An action which ends every path to a label (e.g. the last action of both branches of an if/else) is
+        done once after the label instead. Every jump to the label must be a `Skip`, right after the action."""
+        for index, label in enumerate(actions):
+            if type(label) != self.label or index == 0:
+                continue
+            # Indices of the copies of the action which come before the label
+            tails = []
+            before = actions[index - 1]
+            if type(before) == str:
+                tails.append(index - 1)
+            elif type(before) != self.jump or before.prefix != 'Skip(':
+                continue
+            for position, action in enumerate(actions[:index]):
+                if type(action) == self.jump and action.label is label:
+                    if action.prefix != 'Skip(' or position == 0 or type(actions[position - 1]) != str:
+                        break
+                    tails.append(position - 1)
+            else:
+                if len(tails) > 1 and len(set(actions[tail] for tail in tails)) == 1:
+                    tail = actions[tails[0]]
+                    result = type(actions)(action for position, action in enumerate(actions) if position not in tails)
+                    result.insert(result.index(label) + 1, tail)
+                    return result
+
+class DeadStores:
+    """Removes the actions which set or modify an index of `Global Variable(A)` or `Player Variable(..., A)` that
+    is never read in any rule, and shortens the skips over them. Variables are only removed if every use of
+    the A variables is a read of a known index, and stores read by other dead stores only are dead as well."""
+    STORES = {
+        'Set Global Variable At Index': 'global',
+        'Modify Global Variable At Index': 'global',
+        'Set Player Variable At Index': 'player',
+        'Modify Player Variable At Index': 'player'
+    }
+    SKIP = re.compile(r'^(\s*Skip(?: If\(.*, |\())(\d+)\);$')
+    def __init__(self):
+        # Number of stores removed by variable, as ('global' | 'player', index)
+        self.removed = {}
+
+    @staticmethod
+    def action(line):
+        """Returns the code of the action or condition on an output line."""
+        code = line.strip().rstrip(';')
+        return code[:-len(' == True')] if code.endswith(' == True') else code
+
+    @staticmethod
+    def uses(code):
+        """Returns the variables an action reads and the variable it stores to (or None), or None if it uses the
+        A variables in another way."""
+        tree = Value.parse(code)
+        if tree is None:
+            return None
+        reads = set()
+        store = None
+        kind = DeadStores.STORES.get(tree.name)
+        if kind is not None:
+            variable, index = tree.spans[0:2] if kind == 'global' else tree.spans[1:3]
+            if code[slice(*variable)] == 'A':
+                index = code[slice(*index)]
+                if not index.isdigit():
+                    return None
+                store = (kind, int(index))
+        for value in tree.walk():
+            kind = {'Global Variable': 'global', 'Player Variable': 'player'}.get(value.name)
+            if kind is None:
+                # Any other use of the A variables, such as chasing them, could read any index
+                if 'Variable' in value.name and value.name not in DeadStores.STORES and any(code[slice(*span)] == 'A' for span in value.spans):
+                    return None
+                continue
+            if code[slice(*value.spans[-1])] != 'A':
+                continue
+            parent = value.parent
+            if parent is None or parent.name != 'Value In Array' or len(parent.spans) != 2 or parent.spans[0] != (value.start, value.end):
+                return None
+            index = code[slice(*parent.spans[1])]
+            if not index.isdigit():
+                return None
+            reads.add((kind, int(index)))
+        return reads, store
+
+    def optimize(self, code):
+        """Returns the code without the dead stores."""
+        lines = code.split('\n')
+        # Reads and store of each line which uses a variable
+        uses = {}
+        for number, line in enumerate(lines):
+            if 'Variable' in line and line.endswith(';'):
+                use = DeadStores.uses(DeadStores.action(line))
+                if use is None:
+                    return code
+                uses[number] = use
+        stores = {use[1] for use in uses.values() if use[1] is not None}
+        dead = stores
+        while True:
+            live = set()
+            for reads, store in uses.values():
+                if store not in dead:
+                    live |= reads
+            if not dead & live:
+                break
+            dead = dead - live
+        removed = {number for number, use in uses.items() if use[1] in dead}
+        if not removed:
+            return code
+        for number in removed:
+            store = uses[number][1]
+            self.removed[store] = self.removed.get(store, 0) + 1
+        # Skips count the actions after them, so they are shortened by the removed actions they skip over
+        result = []
+        for number, line in enumerate(lines):
+            if number in removed:
+                continue
+            match = DeadStores.SKIP.match(line)
+            if match:
+                count = int(match.group(2))
+                skipped = sum(1 for x in range(number + 1, number + count + 1) if x in removed)
+                line = match.group(1) + str(count - skipped) + ');'
+            result.append(line)
+        return '\n'.join(result)
+
+class Slots:
+    """Renumbers the indices of `Global Variable(A)` and `Player Variable(..., A)` densely, in separate spaces
+    for global and player variables, and lets temporary variables share indices. A variable is temporary if
+    only the actions of one rule use it, which set it before reading it without a wait or loop in between
+    and without skips into its uses, so that its value never outlives the run of actions between two waits.
+    Variables read by actions which re-evaluate their values, such as `Create Effect`, are never temporary.
+    Temporaries whose uses do not overlap share an index, in one rule or across rules (which only take turns
+    at waits). Indices are only renumbered if every use of the A variables is a known index."""
+    RULE = re.compile(r'(?:disabled )?rule\(')
+    BARRIER = re.compile(r'Wait|Loop')
+    SKIP = re.compile(r'Skip(?: If\(.*, |\()(\d+)\)$')
+    # Strings are matched whole, so that the delimiters in them are skipped
+    DELIMITERS = re.compile(r'"[^"]*"|[()};]')
+    def __init__(self, reserved=0):
+        # Global indices below `reserved` keep their number
+        self.reserved = reserved
+        # Number of indices before and after renumbering, and number of temporaries, by 'global' | 'player'
+        self.before = {'global': 0, 'player': 0}
+        self.after = {'global': 0, 'player': 0}
+        self.temporaries = {'global': 0, 'player': 0}
+        # New index of each variable, by ('global' | 'player', index)
+        self.numbers = {}
+
+    @staticmethod
+    def actions(line):
+        """Yields the actions (or conditions) on an output line as (offset, code). The actions of rules written
+        on one line, such as the setup rules, are split at their semicolons."""
+        stripped = line.strip()
+        if '{' not in stripped:
+            if stripped.endswith(';'):
+                yield len(line) - len(line.lstrip()), DeadStores.action(line)
+            return
+        start = line.find('Actions { ')
+        if start == -1:
+            return
+        start += len('Actions { ')
+        depth = 0
+        for match in Slots.DELIMITERS.finditer(line, start):
+            delimiter = line[match.start()]
+            if delimiter == '(':
+                depth += 1
+            elif delimiter == ')':
+                depth -= 1
+            elif depth:
+                continue
+            elif delimiter == ';':
+                yield start, line[start:match.start()]
+                start = match.end() + 1
+            elif delimiter == '}':
+                break
+
+    @staticmethod
+    def uses(code):
+        """Returns the uses of the A variables in an action as (variable, player, span of the index, store)
+        tuples, where variable is ('global' | 'player', index), player is the code of the player (or None) and
+        store is 'Set' or 'Modify' for the variable an action stores to (or None for reads). Returns None if the
+        action uses the A variables in another way."""
+        tree = Value.parse(code)
+        if tree is None:
+            return None
+        uses = []
+        kind = DeadStores.STORES.get(tree.name)
+        if kind is not None:
+            variable, index = tree.spans[0:2] if kind == 'global' else tree.spans[1:3]
+            if code[slice(*variable)] == 'A':
+                if not code[slice(*index)].isdigit():
+                    return None
+                player = code[slice(*tree.spans[0])] if kind == 'player' else None
+                uses.append(((kind, int(code[slice(*index)])), player, index, tree.name.split()[0]))
+        for value in tree.walk():
+            kind = {'Global Variable': 'global', 'Player Variable': 'player'}.get(value.name)
+            if kind is None:
+                if 'Variable' in value.name and value.name not in DeadStores.STORES and any(code[slice(*span)] == 'A' for span in value.spans):
+                    return None
+                continue
+            if code[slice(*value.spans[-1])] != 'A':
+                continue
+            parent = value.parent
+            if parent is None or parent.name != 'Value In Array' or len(parent.spans) != 2 or parent.spans[0] != (value.start, value.end):
+                return None
+            index = parent.spans[1]
+            if not code[slice(*index)].isdigit():
+                return None
+            player = code[slice(*value.spans[0])] if kind == 'player' else None
+            uses.append(((kind, int(code[slice(*index)])), player, index, None))
+        return uses
+
+    def optimize(self, code):
+        """Returns the code with the variables renumbered."""
+        lines = code.split('\n')
+        # Uses of each variable as (line, rule, position of the action in the actions of the rule, player, span, store)
+        variables = {}
+        # Positions of the waits and loops, of the re-evaluating actions and (position, target) of the skips,
+        # in the actions of each rule
+        barriers = {}
+        reevaluating = {}
+        skips = {}
+        rule = -1
+        block = None
+        position = 0
+        for number, line in enumerate(lines):
+            stripped = line.strip()
+            if Slots.RULE.match(stripped):
+                rule += 1
+                block = None
+                # Rules written on one line are not analyzed, their variables are never temporary
+                if stripped.endswith('}}'):
+                    block = 'Setup'
+            if stripped.endswith(' {'):
+                block = stripped[:-2]
+                position = 0
+                continue
+            for offset, action in Slots.actions(line):
+                if block == 'Actions':
+                    if Slots.BARRIER.match(action):
+                        barriers.setdefault(rule, set()).add(position)
+                    if action.startswith(CommonValues.REEVALUATING):
+                        reevaluating.setdefault(rule, set()).add(position)
+                    skip = Slots.SKIP.match(action)
+                    if skip:
+                        skips.setdefault(rule, []).append((position, position + int(skip.group(1)) + 1))
+                if 'Variable' in action:
+                    uses = Slots.uses(action)
+                    if uses is None:
+                        return code
+                    for variable, player, (start, end), store in uses:
+                        where = position if block == 'Actions' else None
+                        variables.setdefault(variable, []).append((number, rule, where, player, (offset + start, offset + end), store))
+                if block == 'Actions':
+                    position += 1
+        temporaries = {variable: uses for variable, uses in variables.items() if self.temporary(variable, uses, barriers, reevaluating, skips)}
+        numbers = {}
+        for kind in ('global', 'player'):
+            reserved = self.reserved if kind == 'global' else 0
+            persistent = sorted(index for (var_kind, index) in variables if var_kind == kind and (var_kind, index) not in temporaries)
+            moved = [index for index in persistent if index >= reserved]
+            for index in persistent[:len(persistent) - len(moved)]:
+                numbers[kind, index] = index
+            for number, index in enumerate(moved):
+                numbers[kind, index] = reserved + number
+            base = reserved + len(moved)
+            # Temporaries of each rule are given the first index which is free when their uses start
+            colors = 0
+            for rule in sorted({uses[0][1] for (var_kind, _), uses in temporaries.items() if var_kind == kind}):
+                ends = []
+                intervals = sorted((min(use[2] for use in uses), max(use[2] for use in uses), variable)
+                    for variable, uses in temporaries.items() if variable[0] == kind and uses[0][1] == rule)
+                for start, end, variable in intervals:
+                    color = next((color for color, last in enumerate(ends) if last < start), len(ends))
+                    if color == len(ends):
+                        ends.append(end)
+                    else:
+                        ends[color] = end
+                    numbers[variable] = base + color
+                colors = max(colors, len(ends))
+            self.before[kind] = len([variable for variable in variables if variable[0] == kind])
+            self.after[kind] = len(persistent) + colors
+            self.temporaries[kind] = len([variable for variable in temporaries if variable[0] == kind])
+        self.numbers = numbers
+        if all(numbers[variable] == variable[1] for variable in numbers):
+            return code
+        # Indices are replaced from the end of each line, so that the spans before them stay valid
+        replacements = {}
+        for variable, uses in variables.items():
+            for number, rule, where, player, span, store in uses:
+                replacements.setdefault(number, []).append((span, str(numbers[variable])))
+        for number, spans in replacements.items():
+            line = lines[number]
+            for (start, end), index in sorted(spans, reverse=True):
+                line = line[:start] + index + line[end:]
+            lines[number] = line
+        return '\n'.join(lines)
+
+    def temporary(self, variable, uses, barriers, reevaluating, skips):
+        """Whether a variable is only used in one run of the actions of a rule, which sets it first. Reads by
+        re-evaluating actions last beyond the run, like a wait."""
+        kind, index = variable
+        if kind == 'global' and index < self.reserved:
+            return False
+        rule = uses[0][1]
+        if any(use[1] != rule or use[2] is None or use[3] != uses[0][3] for use in uses):
+            return False
+        start = min(use[2] for use in uses)
+        end = max(use[2] for use in uses)
+        first = [use for use in uses if use[2] == start]
+        if any(use[5] != 'Set' for use in first):
+            return False
+        if any(start < position <= end for position in barriers.get(rule, ())):
+            return False
+        if any(use[2] in reevaluating.get(rule, ()) for use in uses):
+            return False
+        return not any(position < start < target <= end for position, target in skips.get(rule, ()))
+
+class Letters:
+    """Moves the most used variables out of the arrays in `Global Variable(A)` and `Player Variable(..., A)`
+    to letters of their own, which are read and set without indexing an array. Variables are ranked by their
+    number of uses in the code, or by the counts of a usage profile. Variables are only moved if every use of
+    the A variables is a known index."""
+    def __init__(self, letters, counts=None):
+        # Free letters by 'global' | 'player'
+        self.letters = letters
+        # Counts of the variables by ('global' | 'player', index) from a profile, instead of their uses in the code
+        self.counts = counts
+        # Letter and count of each moved variable
+        self.moved = {}
+
+    @staticmethod
+    def edits(code):
+        """Returns the uses of the A variables in an action as (variable, edits) tuples, where the edits are
+        (start, end, text) replacements which move the variable to the letter formatted into the text. Returns
+        None if the action uses the A variables in another way."""
+        tree = Value.parse(code)
+        if tree is None:
+            return None
+        uses = []
+        kind = DeadStores.STORES.get(tree.name)
+        if kind is not None:
+            first = 0 if kind == 'global' else 1
+            variable, index, value = tree.spans[first:first + 3]
+            if code[slice(*variable)] == 'A':
+                if not code[slice(*index)].isdigit():
+                    return None
+                # `Set Global Variable At Index(A, 1, ...)` becomes `Set Global Variable(B, ...)`
+                name = (0, len(tree.name), tree.name.replace(' At Index', ''))
+                uses.append(((kind, int(code[slice(*index)])), [name, (variable[0], value[0], '{}, ')]))
+        for value in tree.walk():
+            kind = {'Global Variable': 'global', 'Player Variable': 'player'}.get(value.name)
+            if kind is None:
+                if 'Variable' in value.name and value.name not in DeadStores.STORES and any(code[slice(*span)] == 'A' for span in value.spans):
+                    return None
+                continue
+            variable = value.spans[-1]
+            if code[slice(*variable)] != 'A':
+                continue
+            parent = value.parent
+            if parent is None or parent.name != 'Value In Array' or len(parent.spans) != 2 or parent.spans[0] != (value.start, value.end):
+                return None
+            index = code[slice(*parent.spans[1])]
+            if not index.isdigit():
+                return None
+            # `Value In Array(Global Variable(A), 1)` becomes `Global Variable(B)`
+            uses.append(((kind, int(index)), [(parent.start, value.start, ''), (variable[0], variable[1], '{}'), (value.end, parent.end, '')]))
+        return uses
+
+    def optimize(self, code):
+        """Returns the code with the most used variables moved to letters."""
+        lines = code.split('\n')
+        # Edits of each line as (offset of the action, variable, edits)
+        edits = {}
+        counts = {}
+        for number, line in enumerate(lines):
+            if 'Variable' not in line:
+                continue
+            for offset, action in Slots.actions(line):
+                if 'Variable' not in action:
+                    continue
+                uses = Letters.edits(action)
+                if uses is None:
+                    return code
+                for variable, changes in uses:
+                    counts[variable] = counts.get(variable, 0) + 1
+                    edits.setdefault(number, []).append((offset, variable, changes))
+        if self.counts is not None:
+            counts = {variable: self.counts.get(variable, 0) for variable in counts}
+        for kind, letters in self.letters.items():
+            ranked = sorted((-count, index) for (var_kind, index), count in counts.items() if var_kind == kind and count > 0)
+            for letter, (count, index) in zip(letters, ranked):
+                self.moved[kind, index] = (letter, -count)
+        if not self.moved:
+            return code
+        for number, uses in edits.items():
+            changes = sorted((offset + start, offset + end, text.format(self.moved[variable][0]))
+                for offset, variable, variable_edits in uses if variable in self.moved for start, end, text in variable_edits)
+            line = lines[number]
+            for start, end, text in reversed(changes):
+                line = line[:start] + text + line[end:]
+            lines[number] = line
+        return '\n'.join(lines)
+
+def arithmetic(op, a, b):
+    """Applies a workshop arithmetic operator to numbers (floats) or vectors (tuples), or returns None if the
+    result is not a known value. Division and modulo by zero give 0, and modulo takes the sign of the dividend."""
+    if type(a) == float and type(b) == float:
+        if op == '+':
+            result = a + b
+        elif op == '-':
+            result = a - b
+        elif op == '*':
+            result = a * b
+        elif op == '/':
+            result = a / b if b else 0.0
+        elif op == '%':
+            result = math.fmod(a, b) if b else 0.0
+        elif op == '^':
+            if a < 0 and not b.is_integer() or a == 0 and b < 0:
+                return None
+            try:
+                result = a ** b
+            except OverflowError:
+                return None
+        else:
+            return None
+        return result if math.isfinite(result) else None
+    # Vectors are added and subtracted component-wise, and multiplied or divided by a number or component-wise
+    if op in ('+', '-') and type(a) == tuple and type(b) == tuple or op in ('*', '/') and tuple in (type(a), type(b)):
+        a = a if type(a) == tuple else (a,) * 3
+        b = b if type(b) == tuple else (b,) * 3
+        if not all(type(x) == float for x in a + b):
+            return None
+        result = tuple(arithmetic(op, x, y) for x, y in zip(a, b))
+        return None if None in result else result
+
+def degrees(func):
+    return lambda x: func(math.radians(x))
+
+def in_degrees(func):
+    return lambda *args: math.degrees(func(*args))
+
+class ConstantFolder:
+    """Evaluates the expressions whose value is known at compile time (numbers, booleans and vectors), following
+    the workshop semantics. Anything that cannot be evaluated, or that the workshop might evaluate differently
+    (such as values out of a function's domain), evaluates to None and is left to the workshop."""
+    COMPARISONS = {
+        '<': lambda a, b: a < b,
+        '>': lambda a, b: a > b,
+        '<=': lambda a, b: a <= b,
+        '>=': lambda a, b: a >= b,
+        '==': lambda a, b: a == b,
+        '!=': lambda a, b: a != b
+    }
+    # Workshop values by name, with the types of their arguments and the function computing them
+    FUNCTIONS = {
+        'Absolute Value': ((float,), abs),
+        'Square Root': ((float,), lambda x: math.sqrt(x) if x >= 0 else None),
+        'Sine From Degrees': ((float,), degrees(math.sin)),
+        'Sine From Radians': ((float,), math.sin),
+        'Cosine From Degrees': ((float,), degrees(math.cos)),
+        'Cosine From Radians': ((float,), math.cos),
+        'Tangent From Degrees': ((float,), degrees(math.tan)),
+        'Tangent From Radians': ((float,), math.tan),
+        'Arcsine In Degrees': ((float,), lambda x: math.degrees(math.asin(x)) if -1 <= x <= 1 else None),
+        'Arcsine In Radians': ((float,), lambda x: math.asin(x) if -1 <= x <= 1 else None),
+        'Arccosine In Degrees': ((float,), lambda x: math.degrees(math.acos(x)) if -1 <= x <= 1 else None),
+        'Arccosine In Radians': ((float,), lambda x: math.acos(x) if -1 <= x <= 1 else None),
+        'Arctangent In Degrees': ((float, float), in_degrees(math.atan2)),
+        'Arctangent In Radians': ((float, float), math.atan2),
+        'Min': ((float, float), min),
+        'Max': ((float, float), max),
+        'Add': ((None, None), lambda a, b: arithmetic('+', a, b)),
+        'Subtract': ((None, None), lambda a, b: arithmetic('-', a, b)),
+        'Multiply': ((None, None), lambda a, b: arithmetic('*', a, b)),
+        'Divide': ((None, None), lambda a, b: arithmetic('/', a, b)),
+        'Modulo': ((float, float), lambda a, b: arithmetic('%', a, b)),
+        'Raise To Power': ((float, float), lambda a, b: arithmetic('^', a, b)),
+        'Vector': ((float, float, float), lambda x, y, z: (x, y, z)),
+        'X Component Of': ((tuple,), lambda v: v[0]),
+        'Y Component Of': ((tuple,), lambda v: v[1]),
+        'Z Component Of': ((tuple,), lambda v: v[2]),
+        'Magnitude Of': ((tuple,), lambda v: math.sqrt(sum(x * x for x in v))),
+        'Dot Product': ((tuple, tuple), lambda a, b: sum(x * y for x, y in zip(a, b))),
+        'Distance Between': ((tuple, tuple), lambda a, b: math.sqrt(sum((x - y) ** 2 for x, y in zip(a, b))))
+    }
+    def __init__(self):
+        # Values by node and scope, which the transpiler clears with its memoized code
+        self.values = {}
+        self.folded = 0
+
+    @staticmethod
+    def literal(value):
+        """Returns the workshop code of a value. Numbers are written with the shortest digits which read back
+        as the same float, without an exponent."""
+        if type(value) == bool:
+            return 'True' if value else 'False'
+        elif type(value) == tuple:
+            return 'Vector(' + ', '.join(map(ConstantFolder.literal, value)) + ')'
+        code = format(decimal.Decimal(repr(value)), 'f')
+        code = code.rstrip('0').rstrip('.') if '.' in code else code
+        return '0' if code == '-0' else code
+
+    def fold(self, node, scope):
+        """Returns the code of the value of an expression, or None if it is not known at compile time."""
+        try:
+            value = self.evaluate(node, scope)
+        except RecursionError:
+            return None
+        if value is None:
+            return None
+        self.folded += 1
+        return ConstantFolder.literal(value)
+
+    def evaluate(self, node, scope):
+        key = (id(node), scope)
+        entry = self.values.get(key)
+        if entry is not None:
+            return entry[1]
+        method = getattr(self, 'evaluate' + type(node).__name__, None)
+        value = method(node, scope) if method is not None else None
+        # The node is kept alive with the entry so that its id is not reused
+        self.values[key] = (node, value)
+        return value
+
+    def evaluateNumber(self, node, scope):
+        try:
+            return float(node.value)
+        except ValueError:
+            return None
+
+    def evaluateTime(self, node, scope):
+        time = node.value
+        if time.endswith('ms'):
+            time = float(time.rstrip('ms')) / 1000
+        elif time.endswith('s'):
+            time = float(time.rstrip('s'))
+        elif time.endswith('min'):
+            time = float(time.rstrip('min')) * 60
+        return round(time, 3)
+
+    def evaluateConstant(self, node, scope):
+        return {'TRUE': True, 'FALSE': False}.get(node.name.upper())
+
+    def evaluateVar(self, node, scope):
+        var = scope.get(node.name)
+        if var is None or node.type == Var.STRING or var.type not in (Var.CONST, Var.INTERNAL):
+            return None
+        return self.evaluate(var.value, scope)
+
+    def evaluateVector(self, node, scope):
+        if len(node.children) != 3:
+            return None
+        value = tuple(self.evaluate(child, scope) for child in node.children)
+        return value if all(type(x) == float for x in value) else None
+
+    def evaluateUnaryOp(self, node, scope):
+        value = self.evaluate(node.right, scope)
+        if node.op == 'not':
+            return not value if type(value) == bool else None
+        elif node.op == '-':
+            return arithmetic('*', -1.0, value)
+        elif node.op == '+' and type(value) == float:
+            return abs(value)
+
+    def evaluateBinaryOp(self, node, scope):
+        left = self.evaluate(node.left, scope)
+        if left is None:
+            return None
+        right = self.evaluate(node.right, scope)
+        if right is None:
+            return None
+        if node.op in ('and', 'or'):
+            if type(left) == bool and type(right) == bool:
+                return left and right if node.op == 'and' else left or right
+            return None
+        return arithmetic(node.op, left, right)
+
+    def evaluateCompare(self, node, scope):
+        compare = ConstantFolder.COMPARISONS.get(node.op)
+        if compare is None:
+            return None
+        left = self.evaluate(node.left, scope)
+        right = self.evaluate(node.right, scope)
+        if left is None or type(left) != type(right) or node.op not in ('==', '!=') and type(left) != float:
+            return None
+        return compare(left, right)
+
+    def evaluateAttribute(self, node, scope):
+        index = ('x', 'y', 'z').index(node.name.lower()) if node.name.lower() in ('x', 'y', 'z') else None
+        if index is None:
+            return None
+        value = self.evaluate(node.parent, scope)
+        return value[index] if type(value) == tuple else None
+
+    def evaluateCall(self, node, scope):
+        # The built-in ceil and floor round numbers up and down to integers
+        if type(node.parent) != Var or len(node.args) != 1:
+            return None
+        var = scope.get(node.parent.name)
+        if var is None or var.type != Var.BUILTIN or var.name not in ('ceil', 'floor'):
+            return None
+        value = self.evaluate(node.args[0], scope)
+        if type(value) != float:
+            return None
+        return float(math.ceil(value) if var.name == 'ceil' else math.floor(value))
+
+    def evaluateOWID(self, node, scope):
+        name = node.name.title()
+        if name == 'Round To Integer':
+            if len(node.children) != 2 or type(node.children[1]).__name__ != 'Constant':
+                return None
+            value = self.evaluate(node.children[0], scope)
+            rounding = node.children[1].name.title()
+            if type(value) != float:
+                return None
+            elif rounding == 'Up':
+                return float(math.ceil(value))
+            elif rounding == 'Down':
+                return float(math.floor(value))
+            # Halves are left to the workshop, which may round them either way
+            elif rounding == 'To Nearest' and value % 1 != 0.5:
+                return float(math.floor(value + 0.5))
+            return None
+        function = ConstantFolder.FUNCTIONS.get(name)
+        if function is None:
+            return None
+        types, func = function
+        if len(node.children) != len(types):
+            return None
+        args = []
+        for child, type_ in zip(node.children, types):
+            value = self.evaluate(child, scope)
+            if value is None or type_ is not None and type(value) != type_:
+                return None
+            args.append(value)
+        value = func(*args)
+        if type(value) == float and not math.isfinite(value):
+            return None
+        return value
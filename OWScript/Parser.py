@@ -1,22 +1,172 @@
 import re
+from collections import deque
 from functools import partial
 
 from . import Errors
 from .AST import *
-from .Tokens import ALIASES
+from .Tokens import ALIASES, MAPS
 from .Workshop import *
 
+class TokenStream:
+    """Cursor over a token iterable which pulls tokens on demand and only buffers the tokens peeked ahead."""
+    def __init__(self, tokens):
+        self.tokens = iter(tokens)
+        self.lookahead = deque()
+        self.current = next(self.tokens, None)
+
+    def peek(self, n=1):
+        """Returns the nth token after the current one, or None past the end of the input."""
+        while len(self.lookahead) < n:
+            token = next(self.tokens, None)
+            if token is None:
+                return None
+            self.lookahead.append(token)
+        return self.lookahead[n - 1]
+
+    def advance(self):
+        """Drops the current token and moves on to the next one."""
+        if self.lookahead:
+            self.current = self.lookahead.popleft()
+        else:
+            self.current = next(self.tokens, None)
+
+class StringPatterns:
+    """Decomposes f-strings into nested string constants. The constant patterns are compiled once and the
+    decomposition of every substring is memoized, so each distinct substring is only matched once. A
+    decomposition (plan) is a (pattern, children) pair where a child is either the index of a format
+    argument or an (offset, plan) pair for a nested string whose format arguments start at `offset`."""
+    SPACES = re.compile(r'^ $| (?: +)$')
+    EMPTY = ('', [])
+    patterns = None
+    literals = None
+    cache = {}
+
+    @classmethod
+    def compile(cls):
+        """Compiles the patterns with format placeholders, in priority order, and indexes the literal ones."""
+        cls.patterns = []
+        cls.literals = {}
+        for group in StringConstant.sorted_values:
+            compiled = []
+            for pattern in group:
+                if '{' in pattern:
+                    patt = re.sub(r'([^a-zA-Z0-9_\s{}])', r'\\\1', pattern)
+                    patt = re.sub(r'{\d}', r'(.*?)', patt) + '$'
+                    compiled.append((pattern, re.compile(patt, re.I)))
+                elif pattern:
+                    cls.literals.setdefault(pattern.upper(), pattern)
+            cls.patterns.append(compiled)
+
+    @classmethod
+    def decompose(cls, string):
+        """Returns the plan of `string`, or None if it cannot be written with string constants."""
+        try:
+            return cls.cache[string]
+        except KeyError:
+            pass
+        if cls.patterns is None:
+            cls.compile()
+        plan = cls.match(string)
+        cls.cache[string] = plan
+        return plan
+
+    @classmethod
+    def match(cls, string):
+        if string == '{}':
+            return ('{0}', [0])
+        elif string == '':
+            return cls.EMPTY
+        match = cls.SPACES.match(string)
+        if match:
+            return ('{0} {1}', [(0, cls.EMPTY if len(match.group(0)) == 1 else cls.decompose(string[1:])), (0, cls.EMPTY)])
+        # Format arguments taken by a failed pattern stay consumed for the patterns tried after it
+        consumed = 0
+        for index, group in enumerate(cls.patterns):
+            for pattern, regex in group:
+                match = regex.match(string)
+                if match and not match.group(0) == '':
+                    children = []
+                    for substring in match.groups():
+                        if substring == '{}':
+                            children.append(consumed)
+                            consumed += 1
+                        else:
+                            plan = cls.decompose(substring)
+                            if plan is None:
+                                break
+                            children.append((consumed, plan))
+                    else:
+                        return (pattern, children)
+            if index == len(cls.patterns) - 1:
+                pattern = cls.literals.get(string.upper())
+                if pattern is not None:
+                    return (pattern, [])
+        return None
+
+    @classmethod
+    def build(cls, plan, formats, null):
+        """Creates the String node of a plan, taking format arguments from `formats`."""
+        pattern, children = plan
+        node = String(value=pattern)
+        node.children = [formats[child] if type(child) is int else cls.build(child[1], formats[child[0]:], null) for child in children]
+        node.children += [null] * (3 - len(children))
+        return node
+
+class OWIDTable:
+    """Resolves OWID spellings (upper-cased) to the workshop name they stand for and a factory for its node:
+    a map index Number, a Constant, or an OWID with its argument types. Each spelling is resolved once, on
+    first use, so an OWID token only costs a dict lookup and a new node."""
+    MAPS = {name.upper(): index for index, name in enumerate(MAPS)}
+
+    def __init__(self):
+        self.table = {}
+
+    @staticmethod
+    def resolve(name):
+        """Returns the (name, factory) pair of an upper-cased spelling."""
+        for aliases in ALIASES.values():
+            name = aliases.get(name, name)
+        if name in OWIDTable.MAPS:
+            return name, partial(Number, value=str(OWIDTable.MAPS[name]))
+        node = Workshop[name]
+        if type(node) == OWID:
+            return name, partial(OWID, name=node.name, description=node.description, args=node.args)
+        return name, partial(Constant, name=node.name)
+
+    def __getitem__(self, spelling):
+        try:
+            return self.table[spelling]
+        except KeyError:
+            entry = self.table[spelling] = OWIDTable.resolve(spelling)
+            return entry
+
 class Parser:
+    OWIDS = OWIDTable()
+    # Binding power (higher binds tighter), node type and operator of the binary operators by token type;
+    # comparisons associate to the right, everything else to the left
+    BINARY_OPS = {
+        'OR': (1, BinaryOp, 'or'),
+        'AND': (2, BinaryOp, 'and'),
+        'COMPARE': (4, Compare, None),
+        'IN': (4, Compare, None),
+        'NOT_IN': (4, Compare, None),
+        'PLUS': (5, BinaryOp, None),
+        'MINUS': (5, BinaryOp, None),
+        'TIMES': (6, BinaryOp, None),
+        'DIVIDE': (6, BinaryOp, None),
+        'POW': (7, BinaryOp, None),
+        'MOD': (7, BinaryOp, None)
+    }
+    NOT = (3, UnaryOp, 'not')
     def __init__(self, tokens):
-        self.tokens = tokens
-        self.pos = 0
+        self.tokens = TokenStream(tokens)
         self.chase_vars = set()
         self.map_rule = False
 
     @property
     def curtoken(self):
-        """Returns the token at the current index."""
-        return self.tokens[self.pos]
+        """Returns the token at the cursor."""
+        return self.tokens.current
 
     @property
     def curtype(self):
@@ -25,8 +175,8 @@ class Parser:
 
     @property
     def curpos(self):
-        """Returns the tuple (line, column) of the current token position."""
-        return self.curtoken.line, self.curtoken.column
+        """Returns the location of the current token, which unpacks to the tuple (line, column)."""
+        return Errors.Location(self.curtoken.pos, self.curtoken.lines)
 
     @property
     def curvalue(self):
@@ -35,10 +185,10 @@ class Parser:
 
     def peek(self, n=1):
         """Returns the nth upcoming token."""
-        try:
-            return self.tokens[self.pos + n]
-        except IndexError:
+        token = self.tokens.peek(n)
+        if token is None:
             print('Cannot peek further than token length')
+        return token
 
     def eat(self, *tokens):
         """Consumes a token and moves on to the next one."""
@@ -48,59 +198,18 @@ class Parser:
             return
         # print(self.curtoken)
         token_type = tokens[0]
-        pos = self.curpos
         if self.curtype == token_type:
-            self.pos += 1
+            self.tokens.advance()
         else:
-            raise Errors.ParseError('Expected token of type {}, but received {}'.format(token_type, self.curtype), pos=pos)
+            raise Errors.ParseError('Expected token of type {}, but received {}'.format(token_type, self.curtype), pos=self.curpos)
 
     def parse_string(self, string, formats, _pos):
+        """Builds the String node of an f-string from its (cached) decomposition into string constants."""
         string = re.sub(r'["\'`]', '', string)
-        null = Constant(name='Null')
-        if string == '{}':
-            node = String(value='{0}')
-            node.children = [formats[0]] + [null] * 2
-            return node
-        elif string == '':
-            node = String(value='')
-            node.children = [null] * 3
-            return node
-        else:
-            match = re.match(r'^ $| (?: +)$', string)
-            if match:
-                empty_string = String(value='')
-                empty_string.children = [null] * 3
-
-                node = String(value='{0} {1}')
-                node.children = [
-                    empty_string if len(match.group(0)) == 1 else self.parse_string(string[1:], formats, _pos),
-                    empty_string,
-                    null
-                ]
-                return node
-        for group in StringConstant.sorted_values:
-            for pattern in group:
-                patt = re.sub(r'([^a-zA-Z0-9_\s{}])', r'\\\1', pattern)
-                patt = re.sub(r'{\d}', r'(.*?)', patt) + '$'
-                match = re.match(patt, string, re.I)
-                if match and not match.group(0) == '':
-                    groups = match.groups()
-                    children = []
-                    try:
-                        for group in groups:
-                            if group == '{}':
-                                child = formats[0]
-                                formats = formats[1:]
-                            else:
-                                child = self.parse_string(group, formats, _pos)
-                            children.append(child)
-                    except Errors.StringError:
-                        continue
-                    node = String(value=pattern)
-                    node.children = children + [null] * (3 - len(children))
-                    return node
-        else:
+        plan = StringPatterns.decompose(string)
+        if plan is None:
             raise Errors.StringError('Invalid string \'{}\''.format(string), pos=_pos)
+        return StringPatterns.build(plan, formats, Constant(name='Null'))
 
     def script(self):
         """script : (NEWLINE | stmt)* EOF"""
@@ -362,81 +471,63 @@ class Parser:
         return Return(value=expr)
 
     def expr(self):
-        """expr : logic_or"""
-        node = self.logic_or()
+        """expr : operation"""
+        node = self.operation()
         node._pos = self.curpos
         return node
 
-    def logic_or(self):
-        """logic_or : logic_and (OR logic_and)*"""
-        node = self.logic_and()
-        while self.curtype == 'OR':
-            self.eat('OR')
-            node = BinaryOp(left=node, op='or', right=self.logic_and())
-        return node
-
-    def logic_and(self):
-        """logic_and : logic_not (AND logic_not)*"""
-        node = self.logic_not()
-        while self.curtype == 'AND':
-            self.eat('AND')
-            node = BinaryOp(left=node, op='and', right=self.logic_not())
-        return node
-
-    def logic_not(self):
-        """logic_not : NOT logic_not
-                     | compare"""
-        if self.curtype == 'NOT':
-            self.eat('NOT')
-            return UnaryOp(op='not', right=self.logic_not())
-        return self.compare()
-
-    def compare(self):
-        """compare : term (COMPARE term)*"""
-        node = self.term()
-        while self.curtype in ('COMPARE', 'IN', 'NOT_IN') and self.peek().type not in ('COMMA', 'RPAREN', 'RBRACK', 'NEWLINE'):
-            op = self.curvalue
-            self.eat(self.curtype)
-            node = Compare(left=node, op=op, right=self.compare())
-        return node
+    def operation(self, power=1):
+        """operation : unary (binop unary)*
+           binop : OR | AND | COMPARE | IN | NOT_IN | PLUS | MINUS | TIMES | DIVIDE | POW | MOD
+
+        Parses a chain of binary operators binding at least as tightly as `power` by precedence climbing
+        over explicit operand and operator stacks, so long chains do not recurse. NOT is a prefix operator
+        which is only allowed at the start of the operands of OR, AND and NOT."""
+        tokens = self.tokens
+        binary_ops = Parser.BINARY_OPS
+        operands = []
+        operators = []
+        while True:
+            while tokens.current.type == 'NOT' and power <= Parser.NOT[0] and (not operators or operators[-1][0] <= Parser.NOT[0]):
+                tokens.advance()
+                operators.append(Parser.NOT)
+            operands.append(self.unary())
+            token = tokens.current
+            binop = binary_ops.get(token.type)
+            if binop is None or binop[0] < power or binop[1] is Compare and self.peek().type in ('COMMA', 'RPAREN', 'RBRACK', 'NEWLINE'):
+                break
+            binding, node_type, op = binop
+            while operators and (operators[-1][0] > binding or operators[-1][0] == binding and node_type is not Compare):
+                Parser.reduce(operands, operators.pop())
+            operators.append((binding, node_type, op or token.value))
+            tokens.advance()
+        while operators:
+            Parser.reduce(operands, operators.pop())
+        return operands[0]
+
+    @staticmethod
+    def reduce(operands, operator):
+        """Replaces the operands on top of the stack with the node of the operator applied to them."""
+        _, node_type, op = operator
+        right = operands.pop()
+        if node_type is UnaryOp:
+            operands.append(UnaryOp(op=op, right=right))
+        else:
+            operands.append(node_type(left=operands.pop(), op=op, right=right))
 
     def term(self):
         """term : factor ((PLUS | MINUS) factor)*"""
-        node = self.factor()
-        while self.curtype in ('PLUS', 'MINUS'):
-            op = self.curvalue
-            self.eat(self.curtype)
-            node = BinaryOp(left=node, op=op, right=self.factor())
-        return node
-
-    def factor(self):
-        """factor : powmod ((TIMES | DIVIDE) powmod)*"""
-        node = self.powmod()
-        while self.curtype in ('TIMES', 'DIVIDE'):
-            op = self.curvalue
-            self.eat(self.curtype)
-            node = BinaryOp(left=node, op=op, right=self.powmod())
-        return node
-
-    def powmod(self):
-        """powmod : unary ((POW | MOD) unary)*"""
-        node = self.unary()
-        while self.curtype in ('POW', 'MOD'):
-            op = self.curvalue
-            self.eat(self.curtype)
-            node = BinaryOp(left=node, op=op, right=self.unary())
-        return node
+        return self.operation(Parser.BINARY_OPS['PLUS'][0])
 
     def unary(self):
-        """unary : (PLUS | MINUS) unary
-                 | primary"""
-        if self.curtype in ('PLUS', 'MINUS'):
-            while self.curtype in ('PLUS', 'MINUS'):
-                op = self.curvalue
-                self.eat(self.curtype)
-                node = UnaryOp(op=op, right=self.unary())
-        else:
-            node = self.primary()
+        """unary : (PLUS | MINUS)* primary"""
+        signs = []
+        while self.curtype in ('PLUS', 'MINUS'):
+            signs.append(self.curvalue)
+            self.eat(self.curtype)
+        node = self.primary()
+        for op in reversed(signs):
+            node = UnaryOp(op=op, right=node)
         return node
 
     def primary(self):
@@ -460,14 +551,11 @@ class Parser:
                 | ( expr )"""
         pos = self.curpos
         if self.curtype == 'OWID':
-            name = self.curvalue.upper()
-            for aliases in ALIASES.values():
-                name = aliases.get(name, name)
+            name, factory = Parser.OWIDS[self.curvalue.upper()]
             self.eat('OWID')
-            maps = ['BLACK FOREST', 'BLIZZARD WORLD', 'BUSAN', 'CASTILLO', 'CHÂTEAU GUILLARD', 'DORADO', 'ECOPOINT: ANTARCTICA', 'EICHENWALDE', 'HANAMURA', 'HAVANA', 'HOLLYWOOD', 'HORIZON LUNAR COLONY', 'ILIOS', 'JUNKERTOWN', "KING'S ROW", 'LIJIANG TOWER', 'NECROPOLIS', 'NEPAL', 'NUMBANI', 'OASIS', 'PARIS', 'PETRA', 'RIALTO', 'ROUTE 66', 'TEMPLE OF ANUBIS', 'VOLSKAYA INDUSTRIES', 'WATCHPOINT: GIBRALTAR', 'AYUTTHAYA', 'BUSAN DOWNTOWN', 'BUSAN SANCTUARY', 'ILIOS LIGHTHOUSE', 'ILIOS RUINS', 'ILIOS WELL', 'LIJIANG CONTROL CENTER', 'LIJIANG GARDEN', 'LIJIANG NIGHT MARKET', 'NEPAL SANCTUM', 'NEPAL SHRINE', 'NEPAL VILLAGE', 'OASIS CITY CENTER', 'OASIS GARDENS', 'OASIS UNIVERSITY']
-            if name in maps:
-                return Number(value=str(maps.index(name)))
-            node = Workshop[name]
+            node = factory()
+            if type(node) == Number:
+                return node
             if type(node) == OWID:
                 args = self.args()
                 if args:
@@ -497,7 +585,6 @@ class Parser:
         elif self.curtype == 'LBRACK':
             node = self.array()
         else:
-            pos = (self.curtoken.line, self.curtoken.column)
             raise Errors.ParseError('Unexpected token of type {}'.format(self.curtype), pos=pos)
         node._pos = pos
         return node
@@ -1,14 +1,118 @@
+import re
+
+from . import Errors
+
 class Token:
-    """Stores token information such as data and line number."""
-    def __init__(self, type, value, line, column):
+    """Stores token information such as data and source offset (line and column are looked up on demand).
+    The offset is stored from the start of the block of lines of the token."""
+    __slots__ = ('type', 'value', 'offset', 'block')
+    def __init__(self, type, value, offset, block):
         self.type = type
         self.value = value
-        self.line = line
-        self.column = column
+        self.offset = offset
+        self.block = block
+
+    @property
+    def pos(self):
+        return self.block.pos + self.offset
+
+    @property
+    def lines(self):
+        return self.block.lines
+
+    @property
+    def line(self):
+        return self.lines.line(self.pos)
+
+    @property
+    def column(self):
+        return self.lines.position(self.pos)[1]
 
     def __repr__(self):
         return f'<{self.type}: {self.value} ({self.line}:{self.column})>'
 
+class KeywordTrie:
+    """Case-insensitive trie of keywords which finds the longest keyword at a position in one walk."""
+    END = None
+    def __init__(self, words):
+        self.root = {}
+        for word in words:
+            node = self.root
+            for char in word.lower():
+                node = node.setdefault(char, {})
+            node[KeywordTrie.END] = True
+
+    @staticmethod
+    def boundary(text, pos):
+        """Whether a keyword may end before `pos` (whitespace, brackets, commas, dots or a trailing colon)."""
+        if pos >= len(text):
+            return False
+        char = text[pos]
+        if char.isspace() or char in '\b(),.[]':
+            return True
+        return char == ':' and text[pos + 1:pos + 2] in ('\r', '\n')
+
+    def match(self, text, pos):
+        """Returns the longest keyword starting at `pos` which ends on a boundary, or None."""
+        if pos > 0 and text[pos - 1] == '.':
+            return None
+        node = self.root
+        ends = []
+        end = pos
+        while end < len(text):
+            node = node.get(text[end].lower())
+            if node is None:
+                break
+            end += 1
+            if KeywordTrie.END in node:
+                ends.append(end)
+        for end in reversed(ends):
+            if KeywordTrie.boundary(text, end):
+                return text[pos:end]
+
+def unterminated(text, pos, what):
+    """Error for a comment or string which is not closed, reported at its opening delimiter."""
+    return Errors.LexError('Unterminated {}'.format(what), pos=Errors.Location(pos, Errors.LineIndex(text)))
+
+class Comment:
+    """Matches a block or line comment (with the whitespace before it) by searching for its end with str.find."""
+    LEADING = re.compile(r'\s*')
+    start = r'\s*\/[*/]'
+    def match(self, text, pos):
+        """Returns the comment starting at `pos`, or None."""
+        start = Comment.LEADING.match(text, pos).end()
+        if text.startswith('/*', start):
+            end = text.find('*/', start + 2)
+            if end == -1:
+                raise unterminated(text, start, 'comment')
+            return text[pos:end + 2]
+        elif text.startswith('//', start):
+            end = text.find('\n', start)
+            return text[pos:end if end != -1 else len(text)]
+
+class Quoted:
+    """Matches a single-line string enclosed in one of `quotes` by searching for the closing quote with str.find."""
+    INVALID = '\\\r\n\f'
+    def __init__(self, quotes):
+        self.quotes = quotes
+        self.start = '[{}]'.format(re.escape(quotes))
+
+    def match(self, text, pos):
+        """Returns the string starting at `pos` including its quotes, or None."""
+        if pos >= len(text) or text[pos] not in self.quotes:
+            return None
+        end = text.find(text[pos], pos + 1)
+        stop = end if end != -1 else len(text)
+        for char in Quoted.INVALID:
+            invalid = text.find(char, pos + 1, stop)
+            if invalid != -1:
+                stop = invalid
+        if stop != end:
+            if stop < len(text) and text[stop] == '\\':
+                raise Errors.LexError("Unexpected symbol '\\' in string", pos=Errors.Location(stop, Errors.LineIndex(text)))
+            raise unterminated(text, pos, 'string')
+        return text[pos:end + 1]
+
 ALIASES = {
     'CONST': {
         'CHATEAU GUILLARD': 'CHÂTEAU GUILLARD',
@@ -65,7 +169,7 @@ CONST.sort(key=len, reverse=True)
 
 class Tokens:
     """Mapping of token names to regular expressions."""
-    COMMENT : r'\s*(\/\*(.|[\n])*?\*\/\n*?|\/\/[^\n]*\n*?)'
+    COMMENT : Comment()
     COMPARE : r'(>=|<=|==|!=|>|<)'
     ASSIGN : r'(=|\+=|-=|\*=|\/=|^=|%=)'
     TIME : r'([0-9]+(\.[0-9]+)?)(ms|s|min)'
@@ -84,8 +188,8 @@ class Tokens:
     RPAREN : r'\)'
     LBRACK : r'\['
     RBRACK : r'\]'
-    STRING : r'("[^\\\r\n\f]*?"|\'[^\\\r\n\f]*?\')'
-    F_STRING : r'(`[^\\\r\n\f]*?`)'
+    STRING : Quoted('"\'')
+    F_STRING : Quoted('`')
     IMPORT : r'#IMPORT\b'
     CLASS : r'CLASS\b'
     IF : r'IF\b'
@@ -104,7 +208,7 @@ class Tokens:
     DISABLED : r'DISABLED\b'
     RETURN : r'RETURN\b'
     RULE : r'RULE\b'
-    OWID : fr'(?<!\.)({"|".join(OWID)})(?=([\b\s\n\(\),\.\[\]]|:[\r\n]))'
+    OWID : KeywordTrie(OWID)
     ANNOTATION : r'[_a-zA-Z0-9][_a-zA-Z0-9]*:(?![\r\n])'
     RULEBLOCK : r'(EVENT|CONDITIONS|ACTIONS)\b'
     NAME : r'[_a-zA-Z][_\-a-zA-Z0-9]*'
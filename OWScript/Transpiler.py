@@ -1,5 +1,4 @@
 import os
-import re
 from collections import defaultdict
 from itertools import count
 from string import ascii_uppercase as letters
@@ -7,18 +6,12 @@ from string import ascii_uppercase as letters
 from . import Errors
 from . import Importer
 from .AST import *
-
-def flatten(l):
-    """Helper method to convert a list of lists into a single list."""
-    l = list(l)
-    while l:
-        while l and isinstance(l[0], list):
-            l[0:1] = l[0]
-        if l:
-            yield l.pop(0)
+from .Optimizer import CommonValues, ConstantFolder, DeadStores, Letters, Peephole, Slots
 
 class Scope:
     """Keeps track of defined names in a scope context. Handles lookup and assignment."""
+    # Incremented by every assignment (in any scope), which may change the code of transpiled subtrees
+    version = 0
     def __init__(self, name, parent=None, namespace=None):
         self.name = name
         self.parent = parent
@@ -41,6 +34,7 @@ class Scope:
 
     def assign(self, name, var):
         self.namespace[name] = var
+        Scope.version += 1
 
     def __repr__(self):
         return f"<Scope '{self.name}'[{self.level}]>"
@@ -66,30 +60,133 @@ class Builtin:
         return node
 
     def get_map(tp):
-        node = OWID(name='Index Of Array Value', args=[None] * 2)
+        return Raw(code='Value In Array(Global Variable(A), 0)')
+
+    def map_ids(tp):
+        """The array of the IDs of the maps by their index, which the map rule looks up the ID of the current map in."""
         def map_2pos(a, b):
-            node = Raw(code='First Of(Filtered Array(Append To Array(Append To Array(Empty Array, {}), {}), Compare(Current Array Element, ==, Value In Array(Global Variable(A), 0))))'.format(a, b))
-            return tp.visit(node, tp.scope)
-        elems = list(map(lambda x: Number(value=str(x)), [153, 468, 1196, 135, 139, 477, 184, map_2pos(343, 347), 366, map_2pos(433, 436), 403, map_2pos(382, 384), 993, 386, map_2pos(331, 348), 659, 145, 569, 384, 1150, 371, 179, 497, 374, 312, 324, 434, 297, 276, 330, 376, 347, 480, 310, 342, 360, 364, 372, 370, 450, 356, 305]))
-        array = Array(elements=elems)
-        value = Raw(code='Value In Array(Global Variable(A), 0)')
-        node.children.extend([array, value])
-        return node
+            return Raw(code='First Of(Filtered Array(Append To Array(Append To Array(Empty Array, {}), {}), Compare(Current Array Element, ==, Value In Array(Global Variable(A), 0))))'.format(a, b))
+        elems = list(map(lambda x: x if type(x) == Raw else Number(value=str(x)), [153, 468, 1196, 135, 139, 477, 184, map_2pos(343, 347), 366, map_2pos(433, 436), 403, map_2pos(382, 384), 993, 386, map_2pos(331, 348), 659, 145, 569, 384, 1150, 371, 179, 497, 374, 312, 324, 434, 297, 276, 330, 376, 347, 480, 310, 342, 360, 364, 372, 370, 450, 356, 305]))
+        return Array(elements=elems)
 
     range: range
     ceil: ceil
     floor: floor
     get_map: get_map
 
+class Emitter:
+    """Collects the output as lists of fragments which are joined once, and keeps track of the indentation."""
+    def __init__(self, indent_size=4):
+        self.indent_size = indent_size
+        self.level = 0
+        self.tabs = ''
+        self.buffers = [[]]
+
+    def indent(self, levels=1):
+        """Changes the indentation level and the cached indentation string."""
+        self.level += levels
+        self.tabs = ' ' * self.indent_size * self.level
+
+    def dedent(self):
+        self.indent(-1)
+
+    def begin(self):
+        """Starts collecting fragments in a new buffer."""
+        self.buffers.append([])
+
+    def write(self, *fragments):
+        """Adds fragments to the current buffer."""
+        self.buffers[-1].extend(fragments)
+
+    def mark(self):
+        """Returns the position of the next fragment in the current buffer."""
+        return len(self.buffers[-1])
+
+    def insert(self, mark, *fragments):
+        """Adds fragments to the current buffer at a position returned by `mark`."""
+        self.buffers[-1][mark:mark] = fragments
+
+    def end(self):
+        """Closes the current buffer and returns its text."""
+        return ''.join(self.buffers.pop())
+
+class Label:
+    """A position in an action list which jumps count up to."""
+    __slots__ = ()
+
+class Jump:
+    """A `Skip`/`Skip If` action whose count is the number of actions between it and its label."""
+    __slots__ = ('prefix', 'label', 'suffix')
+    def __init__(self, prefix, label, suffix=')'):
+        self.prefix = prefix
+        self.label = label
+        self.suffix = suffix
+
+class Actions(list):
+    """Intermediate list of actions (code strings, jumps and labels) which statements lower to. Jump counts
+    are computed when the list is resolved into code."""
+    def add(self, code):
+        """Appends the actions of a visit result: an action list, or a string of actions separated by `;\\n`."""
+        if isinstance(code, Actions):
+            self.extend(code)
+        elif code:
+            self.extend(x for x in code.rstrip(';\n').split(';\n') if x)
+        return self
+
+    @staticmethod
+    def join(results):
+        """Joins visit results into one string, or into an action list if any of them is one."""
+        if any(isinstance(result, Actions) for result in results):
+            actions = Actions()
+            for result in results:
+                actions.add(result)
+            return actions
+        return ';\n'.join(results)
+
+    def resolve(self):
+        """Returns the code of the actions, with the counts of the jumps filled in from the label positions."""
+        positions = {}
+        count = 0
+        for action in self:
+            if type(action) == Label:
+                positions[action] = count
+            else:
+                count += 1
+        lines = []
+        for action in self:
+            if type(action) == Jump:
+                lines.append(action.prefix + str(positions[action.label] - len(lines) - 1) + action.suffix)
+            elif type(action) != Label:
+                lines.append(action)
+        return lines
+
 class Transpiler:
     """Compiles a parse tree into a single string output via the `run` method."""
-    def __init__(self, tree, path, logger, credit, indent_size=4):
+    # Expressions whose code only depends on the node and the names in scope, which are memoized
+    MEMOIZED = frozenset(('visitOWID', 'visitCompare', 'visitBinaryOp', 'visitUnaryOp', 'visitVar', 'visitString', 'visitVector', 'visitArray'))
+    # Expressions which may have a value known at compile time
+    FOLDED = frozenset(('visitOWID', 'visitCompare', 'visitBinaryOp', 'visitUnaryOp', 'visitVar', 'visitVector', 'visitAttribute', 'visitCall'))
+    # Optional optimization passes
+    OPTIMIZATIONS = ('cse', 'dce', 'fold', 'peephole', 'slots', 'letters')
+    # Default number of actions up to which loops over arrays known at compile time are unrolled
+    UNROLL_LIMIT = 100
+    # Actions of a runtime loop besides its body, and the default most copies of its body per iteration
+    LOOP_ACTIONS = 6
+    UNROLL_COPIES = 1
+    # Most elements appended one after the other, and fewest elements of an array of known values set in a setup rule
+    ARRAY_DEPTH = 16
+    TABLE_SIZE = 32
+    def __init__(self, tree, path, logger, credit, indent_size=4, optimize=(), unroll_limit=UNROLL_LIMIT, unroll_copies=UNROLL_COPIES, profile=None):
         self.tree = tree
         self.path = path
         self.logger = logger
         self.credit = credit
-        self.indent_size = indent_size
-        self.indent_level = 0
+        self.optimize = frozenset(optimize)
+        self.unroll_limit = unroll_limit
+        self.unroll_copies = unroll_copies
+        # Number of uses of each variable by name, which ranks the variables moved to letters
+        self.profile = profile
+        self.emitter = Emitter(indent_size=indent_size)
         # Reserved Global Indices
         # 0: Map ID
         self.global_reserved = 1
@@ -104,37 +201,53 @@ class Transpiler:
         self.curblock = []
         # Keeps track of absolute import paths to avoid duplicate imports
         self.imports = set()
-
-    @property
-    def tabs(self):
-        return ' ' * self.indent_size * self.indent_level
+        # Transpiled expressions by node and scope, valid for one scope version
+        self.memo = {}
+        self.memo_version = Scope.version
+        self.memo_hits = 0
+        self.memo_misses = 0
+        # Global indices reserved for temporaries, which are only used until the next wait or jump
+        self.temps = []
+        self.common_values = CommonValues(temp=self.temp_index)
+        self.folder = ConstantFolder()
+        self.peephole = Peephole(label=Label, jump=Jump)
+        # Variable names by ('global' | 'player', index), to report dead stores
+        self.names = {}
+        # Global indices of the arrays set in the setup rule, by code
+        self.tables = {}
 
     @property
     def min_wait(self):
         return 'Wait(0.016, Ignore Condition)'
 
+    def temp_index(self, n):
+        """Returns the global index of the n-th temporary, reserving it on first use."""
+        while len(self.temps) <= n:
+            self.temps.append(next(self.global_index))
+        return self.temps[n]
+
+    def constant(self, node, scope):
+        """Returns the value of an expression if it is known at compile time, otherwise None."""
+        self.expire_memo()
+        try:
+            return self.folder.evaluate(node, scope)
+        except RecursionError:
+            return None
+
+    def discard(self, node, scope):
+        """Visits dead code so that the names it defines still exist, and discards its actions (including the
+        jumps that for loops add to the start of the block)."""
+        curblock = self.curblock
+        self.curblock = Actions()
+        self.visit(node, scope)
+        self.curblock = curblock
+
     def base_node(self, node):
         """Gets a node that can be evaluated in the current scope (e.g. not an item, property, or call)."""
         while hasattr(node, 'parent'):
             node = node.parent
         return node
 
-    def resolve_skips(self):
-        """Resolves for/while* continue skips from placeholder text."""
-        skips = []
-        skip_to = []
-        for line_no, line in enumerate(self.curblock):
-            match = re.match(r'\s*//SKIP TO', line)
-            if match:
-                skips.append(line_no)
-                self.curblock[line_no] = re.sub('//SKIP TO', '', line)
-            match = re.match(r'\s*//FOR START', line)
-            if match:
-                skip_to.append(line_no - 1)
-                self.curblock[line_no] = re.sub('//FOR START', '', line)
-        for skip, jump in zip(skips, skip_to[::-1]):
-            self.curblock[skip] = self.curblock[skip].format(jump)
-
     def resolve_import(self, node, scope):
         """Extends the current parse tree by evaluating the given import path (recursively)."""
         children = self.visit(node, scope).children
@@ -168,21 +281,32 @@ class Transpiler:
 
     def visitScript(self, node, scope):
         """Root node generates the final code output and resolves all imports."""
+        emitter = self.emitter
+        emitter.begin()
         # Shameless plug + base code for `get_map` functionality
-        code = ''
         if not self.credit:
-            code += r'rule("Generated by https://github.com/adapap/OWScript") { Event { Ongoing - Global; }}' + '\n'
+            emitter.write(r'rule("Generated by https://github.com/adapap/OWScript") { Event { Ongoing - Global; }}' + '\n')
         if node.map_rule:
-            code += r'rule("Map ID Initialization") { Event { Ongoing - Global; } Actions { Set Global Variable At Index(A, 0, Round To Integer(Add(Distance Between(Nearest Walkable Position(Vector(-500.000, 0, 0)), Nearest Walkable Position(Vector(500, 0, 0))), Distance Between(Nearest Walkable Position(Vector(0, 0, -500.000)), Nearest Walkable Position(Vector(0, 0, 500)))), Down)); }}' + '\n'
+            # The ID of the map is replaced by its index once, so that `get_map` only reads it
+            maps = self.visit(Builtin.map_ids(self), scope)
+            emitter.write(r'rule("Map ID Initialization") { Event { Ongoing - Global; } Actions { Set Global Variable At Index(A, 0, Round To Integer(Add(Distance Between(Nearest Walkable Position(Vector(-500.000, 0, 0)), Nearest Walkable Position(Vector(500, 0, 0))), Distance Between(Nearest Walkable Position(Vector(0, 0, -500.000)), Nearest Walkable Position(Vector(0, 0, 500)))), Down)); ',
+                'Set Global Variable At Index(A, 0, Index Of Array Value(', maps, ', Value In Array(Global Variable(A), 0))); }}\n')
+        # Tables are set in a rule before the others, once all of them are known
+        tables = emitter.mark()
         self.chase_vars.update(node.chase_vars)
-        while len(node.children) > 0:
-            child = node.children[0]
+        # Remaining children in reverse, so that the next one is popped and imports are pushed in its place
+        children = node.children[::-1]
+        node.children = []
+        while children:
+            child = children.pop()
             if type(child) == Import:
-                node.children = self.resolve_import(child, scope) + node.children[1:]
+                children.extend(reversed(self.resolve_import(child, scope)))
             else:
-                code += self.visit(child, scope)
-                node.children = node.children[1:]
-        return code.rstrip('\n')
+                emitter.write(self.visit(child, scope))
+        if self.tables:
+            emitter.insert(tables, 'rule("Table Initialization") { Event { Ongoing - Global; } Actions { ', ' '.join(
+                'Set Global Variable At Index(A, {}, {});'.format(index, code) for code, index in self.tables.items()), ' }}\n')
+        return emitter.end().rstrip('\n')
 
     def visitImport(self, node, scope):
         """Handles `#import` tokens, duplicate imports, and invalid paths."""
@@ -202,16 +326,32 @@ class Transpiler:
             raise Errors.ImportError('Failed to import \'{}\' due to the following error:\n{}'.format(node.path, ex), pos=node._pos)
     def visitRule(self, node, scope):
         """Creates a basic workshop rule."""
-        code = ''
+        emitter = self.emitter
+        emitter.begin()
         if node.disabled:
-            code += 'disabled '
-        code += 'rule('
-        code += '"' + ''.join(x if type(x) == str else self.visit(x, scope) for x in node.name) + '"'
-        self.indent_level += 1
-        code += ') {\n' + '\n'.join(self.visit_children(node, scope)) + '}\n'
-        self.indent_level -= 1
+            emitter.write('disabled ')
+        emitter.write('rule("', ''.join(x if type(x) == str else self.visit(x, scope) for x in node.name), '"')
+        emitter.indent()
+        dead = 'dce' in self.optimize and self.dead_rule(node, scope)
+        emitter.write(') {\n', '\n'.join(self.visit_children(node, scope)), '}\n')
+        emitter.dedent()
+        code = emitter.end()
+        if dead:
+            self.logger.info('Removed rule "{}" with a constant False condition'.format(''.join(x for x in node.name if type(x) == str)))
+            return ''
         return code
 
+    def dead_rule(self, node, scope):
+        """Whether any condition of a rule is constant False, so that the rule never runs."""
+        ruleblocks = [x for child in node.children for x in (child.children if type(child) == Block else [child])]
+        for ruleblock in ruleblocks:
+            if type(ruleblock) == Ruleblock and ruleblock.name.upper() == 'CONDITIONS':
+                for block in ruleblock.children:
+                    for line in block.children:
+                        if self.constant(line, scope) is False:
+                            return True
+        return False
+
     def visitRaw(self, node, scope):
         """Returns an exact value for a string without further interpretation."""
         return node.code
@@ -236,34 +376,32 @@ class Transpiler:
 
     def visitRuleblock(self, node, scope):
         """A rule category such as Events, Conditions, or Actions."""
+        emitter = self.emitter
         if not node.children:
-            return self.tabs + node.name + '{}\n'
-        code = self.tabs + node.name + ' {'
-        block = ''
-        self.indent_level += 1
-        block = ''
+            return emitter.tabs + node.name + '{}\n'
+        header = emitter.tabs + node.name + ' {'
+        # Automatically compare any condition to true
+        conditions = node.name.upper() == 'CONDITIONS'
+        suffix = ' == True' if conditions else ''
+        emitter.indent()
+        blocks = []
         for ruleblock in node.children:
-            self.curblock = []
+            self.curblock = Actions()
             for line in ruleblock.children:
-                result = self.visit(line, scope)
-                if result:
-                    result = result.rstrip(';\n').split(';\n')
-                    for x in result:
-                        if x:
-                            child = self.tabs + x
-                            # Automatically compare any condition to true
-                            if node.name.upper() == 'CONDITIONS':
-                                child += ' == True'
-                            self.curblock.append(child)
-            self.resolve_skips()
-            block += ';\n'.join(self.curblock)
-        if block:
-            code += '\n' + block
-        else:
-            return code + '}\n'
-        self.indent_level -= 1
-        code += ';\n' + self.tabs + '}\n'
-        return code
+                if conditions and 'dce' in self.optimize and self.constant(line, scope) is True:
+                    self.logger.info('Removed constant True condition (Line {}:{})'.format(*line._pos))
+                    continue
+                self.curblock.add(self.visit(line, scope))
+            if 'cse' in self.optimize and node.name.upper() == 'ACTIONS':
+                self.curblock = self.common_values.optimize(self.curblock)
+            if 'peephole' in self.optimize and node.name.upper() == 'ACTIONS':
+                self.curblock = self.peephole.optimize(self.curblock)
+            blocks.append(';\n'.join(emitter.tabs + x + suffix for x in self.curblock.resolve()))
+        emitter.dedent()
+        block = ''.join(blocks)
+        if not block:
+            return header + '}\n'
+        return ''.join((header, '\n', block, ';\n', emitter.tabs, '}\n'))
 
     def visitOWID(self, node, scope):
         """A workshop value that takes any number of parameters, such as `Set Facing(...)`."""
@@ -276,11 +414,11 @@ class Transpiler:
             raise Errors.SyntaxError('\'{}\' expected {} arguments ({}), received {}'.format(
                 name, len(node.args), ', '.join(map(lambda arg: arg.__name__, node.args)), len(node.children)),
                 pos=node._pos)
+        # Each child is transpiled once; its code doubles as the value checked against the argument type
+        children = []
         for index, types in enumerate(zip(node.args, node.children[:])):
             arg, child = types
-            if arg is None:
-                continue
-            elif arg == Variable:
+            if arg == Variable:
                 if not type(child) == Var:
                     raise Errors.InvalidParameter('Expected variable in chase variable expression, received {}'.format(
                         child.__class__.__name__), pos=child._pos)
@@ -289,17 +427,22 @@ class Transpiler:
                     raise Errors.NameError('\'{}\' is undefined'.format(child.name), pos=node._pos)
                 node.children[index] = Raw(code=var.data.letter)
                 print(var.data.letter)
+                children.append(self.visit(node.children[index], scope))
                 continue
-            values = list(map(lambda x: x.replace(',', ''), flatten(arg.get_values())))
-            value = self.visit(child, scope).upper()
-            if value in HeroConstant._values and name != 'Hero':
+            child_code = self.visit(child, scope)
+            children.append(child_code)
+            if arg is None:
+                continue
+            values = arg.value_set()
+            value = child_code.upper()
+            if value in HeroConstant.value_set() and name != 'Hero':
                 node.children[index] = Constant(name='Hero({})'.format(value.title()))
+                children[index] = self.visit(node.children[index], scope)
             if 'ANY' in values:
                 continue
             if value not in values:
                 raise Errors.InvalidParameter('\'{}\' expected type {} for argument {}'.format(
                     name, arg.__name__, index + 1), pos=child._pos)
-        children = [self.visit(child, scope) for child in node.children]
         code += '(' + ', '.join(children) + ')'
         return code
 
@@ -345,6 +488,7 @@ class Transpiler:
                     else:
                         index = next(self.global_index)
                     var.data = GlobalVar(letter=letter, index=index)
+                    self.names['global', index] = name
                 elif var.type == Var.PLAYER:
                     if name in self.chase_vars:
                         if name not in self.letters:
@@ -355,9 +499,10 @@ class Transpiler:
                         letter = self.letters[name]
                         index = None
                     else:
-                        index = next(self.global_index)
+                        index = next(self.player_index)
                     player = self.resolve_name(var.player, scope)
                     var.data = PlayerVar(letter=letter, index=index, player=player)
+                    self.names['player', index] = name
             elif var.type != Var.GLOBAL and cur_var.type != var.type:
                 self.logger.warn('Ignoring type reassign for \'{}\' (Line {}:{})'.format(var.name, *var._pos))
                 var = cur_var
@@ -409,69 +554,86 @@ class Transpiler:
             return code
         if var.type == Var.GLOBAL:
             if data.index is not None:
-                code += 'Set Global Variable At Index({}, {}, {})'.format(data.letter, data.index, self.visit(var.value, scope))
+                code += 'Set Global Variable At Index({}, {}, {})'.format(data.letter, data.index, value)
             else:
-                code += 'Set Global Variable({}, {})'.format(data.letter, self.visit(var.value, scope))
+                code += 'Set Global Variable({}, {})'.format(data.letter, value)
         elif var.type == Var.PLAYER:
             if data.index is not None:
-                code += 'Set Player Variable At Index({}, {}, {}, {})'.format(self.visit(data.player, scope), data.letter, data.index, self.visit(var.value, scope))
+                code += 'Set Player Variable At Index({}, {}, {}, {})'.format(self.visit(data.player, scope), data.letter, data.index, value)
             else:
-                code += 'Set Player Variable({}, {}, {})'.format(self.visit(data.player, scope), data.letter, self.visit(var.value, scope))
+                code += 'Set Player Variable({}, {}, {})'.format(self.visit(data.player, scope), data.letter, value)
         return code
 
     def visitIf(self, node, scope):
         """If blocks contain a true and false block to evaluate. To simulate this in workshop, the false block
         is skipped when the condition is true, and vice-versa."""
+        if 'dce' in self.optimize:
+            value = self.constant(node.cond, scope)
+            if type(value) == bool:
+                return self.visit_branch(node, scope, value)
         cond = self.visit(node.cond, scope)
-        skip_code = 'Skip If(Not({}), {});\n'
-        skip_false = ''
-        true_code = ';\n'.join(self.visit_children(node.true_block, scope)) + ';\n'
-        false_code = ''
+        skip_true = Label()
+        actions = Actions([Jump('Skip If(Not(' + cond + '), ', skip_true)])
+        for line in node.true_block.children:
+            actions.add(self.visit(line, scope))
         if node.false_block:
-            skip_false = 'Skip({});\n'
+            skip_false = Label()
+            actions += [Jump('Skip(', skip_false), skip_true]
             if type(node.false_block) == If:
-                false_code += self.visit(node.false_block, scope)
+                actions.add(self.visit(node.false_block, scope))
             else:
                 for line in node.false_block.children:
-                    false_code += self.visit(line, scope) + ';\n'
-        skip_code = skip_code.format(cond, true_code.count(';\n') + bool(node.false_block))
-        if false_code:
-            skip_false = skip_false.format(false_code.count(';\n'))
-        code = skip_code + true_code + skip_false + false_code
-        return code
+                    actions.add(self.visit(line, scope))
+            actions.append(skip_false)
+        else:
+            actions.append(skip_true)
+        return actions
+
+    def visit_branch(self, node, scope, value):
+        """Returns the actions of the branch of an if statement which its constant condition selects."""
+        self.logger.info('Removed {} branch of if statement with a constant condition (Line {}:{})'.format(
+            'else' if value else 'if', *node.cond._pos))
+        actions = Actions()
+        for branch, block in ((True, node.true_block), (False, node.false_block)):
+            if not block:
+                continue
+            lines = [block] if type(block) == If else block.children
+            for line in lines:
+                if branch == value:
+                    actions.add(self.visit(line, scope))
+                else:
+                    self.discard(line, scope)
+        return actions
 
     def visitWhile(self, node, scope):
         """While loop is simulated by looping the action list while a condition is met.
         Support for while loops is limited."""
-        skip_cond = 'Skip If(Not({}), {});\n'
+        if 'dce' in self.optimize and self.constant(node.cond, scope) is False:
+            self.logger.info('Removed while loop with a constant False condition (Line {}:{})'.format(*node.cond._pos))
+            for line in node.body.children:
+                self.discard(line, scope)
+            return ''
         cond = self.visit(node.cond, scope)
-        block = ';\n'.join(self.visit_children(node.body, scope)) + ';\n'
-        loop_cond = ';\n{};\nLoop If({})'.format(self.min_wait, cond)
-        num_skips = block.count(';\n') + 2 # Include wait/loop skip
-        skip_cond = skip_cond.format(self.visit(node.cond, scope), num_skips)
-        code = skip_cond + block + loop_cond
-        return code
+        end = Label()
+        actions = Actions([Jump('Skip If(Not(' + cond + '), ', end)])
+        for line in node.body.children:
+            actions.add(self.visit(line, scope))
+        actions += [self.min_wait, 'Loop If(' + cond + ')', end]
+        return actions
 
     def visitFor(self, node, scope):
         """For loops store a pointer to each element in an iterable and loop the action list until the pointer
         is at the end of the iterable (length of iterable). If the length is a known value (e.g. user-created array),
         then loop unrolling is possible to reduce time and number of actions."""
-        code = ''
         pointer = node.pointer
         iterable = node.iterable
         if type(iterable) == Var:
-            lines = []
             array = scope.get(iterable.name).value
             try:
                 assert type(array) == Array
             except AssertionError:
                 raise Errors.SyntaxError('{} is not iterable'.format(iterable.name), pos=iterable._pos)
-            for elem in array.elements:
-                scope = Scope(name='for', parent=scope)
-                var = Var(name=pointer.name, type_=Var.INTERNAL, value=elem)
-                scope.assign(pointer.name, var)
-                lines.append(';\n'.join(self.visit_children(node.body, scope)))
-            code += ';\n'.join(lines)
+            return self.unroll(node, scope, array.elements, chain=True)
         elif type(iterable) == Call:
             func_name = self.base_node(iterable).name
             func = scope.get(func_name).value
@@ -479,37 +641,160 @@ class Transpiler:
                 self.scope = scope
                 array = func(*([self] + iterable.args))
                 assert type(array) == Array
-                lines = []
-                for elem in array.elements:
-                    for_scope = Scope(name='for', parent=scope)
-                    var = Var(name=pointer.name, type_=Var.INTERNAL, value=elem)
-                    for_scope.assign(pointer.name, var)
-                    result = self.visit_children(node.body, for_scope)
-                    if result:
-                        lines.append(';\n'.join(result))
-                code += ';\n'.join(lines)
+                return self.unroll(node, scope, array.elements)
             except AssertionError:
                 raise Errors.SyntaxError('Function call did not return an array', pos=iterable._pos)
             except TypeError as ex:
                 self.logger.debug('For loop TypeError:', ex)
+                return Actions()
         else:
-            for_scope = Scope(name='for', parent=scope)
-            value = Number(value='0')
+            count = 'Count Of(' + self.visit(iterable, scope) + ')'
+            return self.runtime_loop(node, scope, count)
+
+    def loop_body(self, node, scope):
+        """Visits the body of a loop, returning its actions and the jumps which its own loops add to the start
+        of the block."""
+        curblock = self.curblock
+        self.curblock = Actions()
+        body = Actions()
+        for line in node.body.children:
+            body.add(self.visit(line, scope))
+        entries = self.curblock
+        self.curblock = curblock
+        return body, entries
+
+    @staticmethod
+    def size(actions):
+        """Returns the number of actions in an action list."""
+        return sum(type(action) != Label for action in actions)
+
+    @staticmethod
+    def loops(body, entries):
+        """Checks whether the actions of a loop body contain a loop."""
+        return bool(entries) or any(type(action) == str and action.startswith('Loop') for action in body)
+
+    def loop_copies(self, size, length=None):
+        """Returns how many copies of a loop body of `size` actions to emit for a loop over `length` elements
+        (None if only known at runtime): `length` to unroll it fully, 2 or more to unroll it partially (each
+        copy moves the pointer and checks for the end of the array, up to the copies asked for) or 1 to loop once
+        per element."""
+        if length is not None and length * size <= self.unroll_limit:
+            return length
+        copies = (self.unroll_limit - Transpiler.LOOP_ACTIONS) // (size + 2)
+        return max(1, min(copies, self.unroll_copies, length - 1 if length is not None else copies))
+
+    @staticmethod
+    def substitute(actions, old, new):
+        """Returns the actions with a code replaced in the actions and jumps."""
+        return Actions(action.replace(old, new) if type(action) == str else
+            Jump(action.prefix.replace(old, new), action.label, action.suffix) if type(action) == Jump else action for action in actions)
+
+    @staticmethod
+    def shape(actions):
+        """Returns a comparable form of the actions, with the labels numbered in order."""
+        labels = {id(action): number for number, action in enumerate(x for x in actions if type(x) == Label)}
+        return [action if type(action) == str else
+            ('jump', action.prefix, action.suffix, labels.get(id(action.label))) if type(action) == Jump else ('label', labels[id(action)])
+            for action in actions]
+
+    def unroll(self, node, scope, elements, chain=False):
+        """Unrolls a loop over the elements of an array known at compile time, unless its actions would exceed
+        the unroll limit. Then, the elements are read from an array at runtime if they are known values and the
+        body only uses them as values. With `chain`, the scope of each element is nested in the scope of the
+        previous one."""
+        if not elements:
+            return Actions()
+        pointer = node.pointer
+        for_scope = Scope(name='for', parent=scope)
+        for_scope.assign(pointer.name, Var(name=pointer.name, type_=Var.INTERNAL, value=elements[0]))
+        actions, entries = self.loop_body(node, for_scope)
+        size = Transpiler.size(actions)
+        copies = self.loop_copies(size, len(elements))
+        where = 'For loop over {} elements of {} action(s) (Line {}:{}):'.format(len(elements), size, *pointer._pos)
+        if copies < len(elements):
+            values = [self.constant(elem, scope) for elem in elements]
+            if Transpiler.loops(actions, entries):
+                self.logger.debug(where, 'unrolled, since its body has a loop')
+            elif None in values:
+                self.logger.debug(where, 'unrolled, since its elements are not known values')
+            else:
+                # Numbers counting by a step are computed from the pointer instead of stored in an array
+                steps = set(b - a for a, b in zip(values, values[1:])) if all(type(value) == float for value in values) else ()
+                if len(steps) == 1:
+                    first, step = values[0], steps.pop()
+                    element = '{counter}' if step == 1 else 'Multiply({counter}, ' + ConstantFolder.literal(step) + ')'
+                    element = element if first == 0 else 'Add(' + element + ', ' + ConstantFolder.literal(first) + ')'
+                else:
+                    element = 'Value In Array({array}, {counter})'
+                # The body of the runtime loop must be the body of the first and last elements, with their values
+                last_scope = Scope(name='for', parent=for_scope)
+                last_scope.assign(pointer.name, Var(name=pointer.name, type_=Var.INTERNAL, value=elements[-1]))
+                samples = [(ConstantFolder.literal(values[0]), actions), (ConstantFolder.literal(values[-1]), self.loop_body(node, last_scope)[0])]
+                loop = self.runtime_loop(node, for_scope, str(len(elements)), element=element, copies=copies, samples=samples, values=values)
+                if loop is not None:
+                    return loop
+                self.logger.debug(where, 'unrolled, since its body depends on the values of the elements at compile time')
+        else:
+            self.logger.debug(where, 'unrolled')
+        self.curblock[0:0] = entries
+        for elem in elements[1:]:
+            for_scope = Scope(name='for', parent=for_scope if chain else scope)
+            for_scope.assign(pointer.name, Var(name=pointer.name, type_=Var.INTERNAL, value=elem))
+            for line in node.body.children:
+                actions.add(self.visit(line, for_scope))
+        return actions
+
+    def runtime_loop(self, node, scope, count, element=None, copies=None, samples=(), values=None):
+        """Loops the action list once per `copies` elements, until a global variable counting the elements
+        reaches `count`. The loop pointer is the counter, or the `element` code formatted with the `counter`
+        and the `array` of the known `values`. If the body differs from the (value, body) samples with the
+        value in place of the element, returns None."""
+        pointer = node.pointer
+        for_scope = Scope(name='for', parent=scope)
+        if element is None:
             index = next(self.global_index)
-            pointer_var = GlobalVar(letter='A', index=index)
-            var = Var(name=pointer.name, type_=Var.GLOBAL, value=value, data=pointer_var)
+            counter = 'Value In Array(Global Variable(A), {})'.format(index)
+            var = Var(name=pointer.name, type_=Var.GLOBAL, value=Number(value='0'), data=GlobalVar(letter='A', index=index))
+        else:
+            # The body is visited with a placeholder, so that no index is taken unless the loop is used
+            code = element.format(counter='Value In Array(Global Variable(A), -1)', array='Empty Array')
+            var = Var(name=pointer.name, type_=Var.INTERNAL, value=Raw(code=code))
+        for_scope.assign(pointer.name, var)
+        body, entries = self.loop_body(node, for_scope)
+        if element is not None:
+            for value, sample in samples:
+                if Transpiler.shape(Transpiler.substitute(body, code, value)) != Transpiler.shape(sample):
+                    return None
+            index = next(self.global_index)
+            counter = 'Value In Array(Global Variable(A), {})'.format(index)
+            array = self.array(list(map(ConstantFolder.literal, values)), table=len(values) >= Transpiler.TABLE_SIZE) if '{array}' in element else None
+            var = Var(name=pointer.name, type_=Var.INTERNAL, value=Raw(code=element.format(counter=counter, array=array)))
             for_scope.assign(pointer.name, var)
-            reset_pointer = 'Set Global Variable At Index(A, {}, 0);\n'.format(index)
-            code += reset_pointer
-            skip_code = '//FOR STARTSkip If(Compare(Count Of({}), ==, {}), {})'.format(self.visit(iterable, for_scope), self.visit(pointer, for_scope), '{}')
-            block = ';\n'.join(self.visit_children(node.body, for_scope) + [
-                'Modify Global Variable At Index(A, {}, Add, 1)'.format(index),
-                self.min_wait,
-                'Loop',
-                reset_pointer])
-            code += skip_code.format(block.count(';\n')) + ';\n' + block
-            self.curblock.insert(0, self.tabs + '//SKIP TOSkip If(Compare(Value In Array(Global Variable(A), {}), !=, 0), {})'.format(index, '{}'))
-        return code
+            body = Transpiler.substitute(body, code, var.value.code)
+        if copies is None:
+            size = Transpiler.size(body)
+            copies = 1 if Transpiler.loops(body, entries) else self.loop_copies(size)
+            self.logger.debug('For loop over a workshop array of {} action(s) (Line {}:{}):'.format(size, *pointer._pos),
+                '{} copies per iteration'.format(copies) if copies > 1 else 'runtime loop')
+        else:
+            self.logger.debug('For loop over {} elements of {} action(s) (Line {}:{}):'.format(count, Transpiler.size(body), *pointer._pos),
+                '{} copies per iteration'.format(copies) if copies > 1 else 'runtime loop')
+        reset_pointer = 'Set Global Variable At Index(A, {}, 0)'.format(index)
+        start = Label()
+        end = Label()
+        done = 'Skip If(Compare(' + count + ', ==, ' + counter + '), '
+        actions = Actions([reset_pointer, start, Jump(done, end)])
+        for copy in range(copies):
+            if copy:
+                actions.append(Jump(done, end))
+                body = self.loop_body(node, for_scope)[0]
+            actions += body
+            actions.append('Modify Global Variable At Index(A, {}, Add, 1)'.format(index))
+        actions += [self.min_wait, 'Loop', reset_pointer, end]
+        self.curblock[0:0] = entries
+        # Once the action list loops, skip straight to the loop condition
+        self.curblock.insert(0, Jump('Skip If(Compare({}, !=, 0), '.format(counter), start))
+        return actions
 
     def visitBinaryOp(self, node, scope):
         """A binary expression takes two operands and one operator (addition, expontentiation, etc)."""
@@ -559,8 +844,9 @@ class Transpiler:
         var = scope.get(node.name)
         if not var:
             raise Errors.NameError('\'{}\' is undefined'.format(node.name), pos=node._pos)
-        elif node.type == Var.STRING:
+        elif node.type == Var.STRING and var.type != Var.STRING:
             var.type = Var.STRING
+            Scope.version += 1
         if node.type != Var.GLOBAL and var.type != node.type:
             self.logger.warn('Ignoring type reassign for \'{}\' (Line {}:{})'.format(node.name, *node._pos))
         code = ''
@@ -629,13 +915,25 @@ class Transpiler:
                     elements.append(Constant(name='Null'))
                 else:
                     elements.append(elem)
-            num_elems = len(elements)
-            if num_elems == 0:
-                return 'Empty Array'
-            code = 'Append To Array(' * num_elems
-            code += 'Empty Array, ' + '), '.join(self.visit(elem, scope) for elem in elements) + ')'
+            table = len(elements) >= Transpiler.TABLE_SIZE and all(self.constant(elem, scope) is not None for elem in elements)
+            code = self.array([self.visit(elem, scope) for elem in elements], table=table)
         return code
 
+    def array(self, elements, table=False):
+        """Returns the code of an array of element codes. Long arrays are appended as a balanced tree of
+        sub-arrays to limit their nesting, and with `table` they are read from a variable set in a setup rule."""
+        def append(elements):
+            if len(elements) <= Transpiler.ARRAY_DEPTH:
+                return 'Append To Array(' * len(elements) + 'Empty Array, ' + '), '.join(elements) + ')'
+            half = len(elements) // 2
+            return 'Append To Array(' + append(elements[:half]) + ', ' + append(elements[half:]) + ')'
+        code = append(elements) if elements else 'Empty Array'
+        if not table:
+            return code
+        if code not in self.tables:
+            self.tables[code] = next(self.global_index)
+        return 'Value In Array(Global Variable(A), {})'.format(self.tables[code])
+
     def visitItem(self, node, scope, visit=True):
         """An item is accessing an element of an array."""
         # Try to access an array element by interpreting the number?
@@ -717,7 +1015,7 @@ class Transpiler:
                 raise Errors.InvalidParameter("'{}' method received invalid arguments".format(parent.name), pos=parent._pos)
             if result:
                 lines.append(self.visit(result, scope))
-            return ';\n'.join(lines)
+            return Actions.join(lines)
         elif type(parent) is not Var:
             self.logger.debug('Called by parent of type {}', type(parent))
         if not var:
@@ -780,7 +1078,7 @@ class Transpiler:
                 lines.append(self.visit(result, scope))
             except TypeError as ex:
                 self.logger.debug('TypeError in built-in function {}:'.format(var.name), ex)
-        return ';\n'.join(lines)
+        return Actions.join(lines)
 
     def visitReturn(self, node, scope):
         """Return statements break out of functions early."""
@@ -788,11 +1086,38 @@ class Transpiler:
             raise Errors.ReturnError(value=node.value)
         return ''
 
+    def expire_memo(self):
+        """Clears the memoized code and values after an assignment."""
+        if self.memo_version != Scope.version:
+            self.memo.clear()
+            self.folder.values.clear()
+            self.memo_version = Scope.version
+
     def visit(self, node, scope):
         """Finds the relevant transpiler method for the current node."""
         method_name = 'visit' + type(node).__name__
         visitor = getattr(self, method_name)
-        return visitor(node, scope)
+        memoized = method_name in Transpiler.MEMOIZED
+        if not memoized and method_name not in Transpiler.FOLDED:
+            return visitor(node, scope)
+        self.expire_memo()
+        key = (id(node), scope)
+        if memoized:
+            entry = self.memo.get(key)
+            if entry is not None:
+                self.memo_hits += 1
+                return entry[1]
+            self.memo_misses += 1
+        code = None
+        if 'fold' in self.optimize and method_name in Transpiler.FOLDED:
+            code = self.folder.fold(node, scope)
+        if code is None:
+            code = visitor(node, scope)
+        # Code depending on an assignment made while visiting (e.g. by a function call) is not reused
+        if memoized and self.memo_version == Scope.version:
+            # The node is kept alive with the entry so that its id is not reused
+            self.memo[key] = (node, code)
+        return code
 
     def visit_children(self, node, scope):
         """Convenience function to visit all children of a node."""
@@ -808,4 +1133,40 @@ class Transpiler:
             var = Var(name=func_name, type_=Var.BUILTIN, value=func)
             global_scope.assign(func_name, var)
         code = self.visit(self.tree, scope=global_scope)
+        if 'dce' in self.optimize:
+            dead_stores = DeadStores()
+            code = dead_stores.optimize(code)
+            for (kind, index), count in sorted(dead_stores.removed.items()):
+                self.logger.info('Removed {} store(s) to unread {} variable \'{}\''.format(count, kind, self.names.get((kind, index), index)))
+        if 'slots' in self.optimize:
+            slots = Slots(reserved=self.global_reserved)
+            code = slots.optimize(code)
+            for kind in ('global', 'player'):
+                self.logger.debug('{} variable indices: {} used for {} variables ({} temporary)'.format(
+                    kind.capitalize(), slots.after[kind], slots.before[kind], slots.temporaries[kind]))
+            names = {}
+            for variable, name in self.names.items():
+                # The indices are unchanged if the slots could not be renumbered
+                if variable in slots.numbers or not slots.numbers:
+                    names.setdefault((variable[0], slots.numbers.get(variable, variable[1])), []).append(name)
+        else:
+            names = {variable: [name] for variable, name in self.names.items()}
+        if 'letters' in self.optimize:
+            # Letters which are not taken by chase variables
+            free = {'global': list(self.global_letters), 'player': list(self.player_letters)}
+            counts = None
+            if self.profile is not None:
+                counts = {variable: sum(self.profile.get(name, 0) for name in variable_names) for variable, variable_names in names.items()}
+            letters = Letters(letters=free, counts=counts)
+            code = letters.optimize(code)
+            for (kind, index), (letter, count) in sorted(letters.moved.items()):
+                name = '\'{}\''.format(', '.join(names[kind, index])) if (kind, index) in names else 'at index {}'.format(index)
+                self.logger.debug('Moved {} variable {} ({} uses) to letter {}'.format(kind, name, count, letter))
+        self.logger.debug('Memoized expressions: {} hits, {} misses'.format(self.memo_hits, self.memo_misses))
+        if 'fold' in self.optimize:
+            self.logger.debug('Expressions folded into constants: {}'.format(self.folder.folded))
+        if 'cse' in self.optimize:
+            self.logger.debug('Common values stored in temporaries: {} (using {} global indices)'.format(self.common_values.shared, len(self.temps)))
+        if 'peephole' in self.optimize:
+            self.logger.debug('Peephole rewrites: {} ({} actions saved)'.format(self.peephole.rewrites, self.peephole.saved))
         return code
@@ -1,4 +1,6 @@
-import json
+import hashlib
+import marshal
+import os
 
 try:
     from .AST import *
@@ -6,40 +8,77 @@ except ImportError:
     from AST import *
 
 class WorkshopData:
-    """Manager for workshop type data."""
-    def __init__(self):
+    """Manager for workshop type data. The data is loaded on first use, from a marshal cache of the
+    JSON file (named after the hash of its contents) when there is one."""
+    PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Workshop.json')
+    CACHE = os.path.join(os.path.dirname(PATH), '__pycache__', 'Workshop.{}.marshal')
+    def __init__(self, path=PATH):
+        self.path = path
+        self._data = None
+
+    @property
+    def data(self):
+        """Returns the workshop data, loading it if needed."""
+        if self._data is None:
+            self.load()
+        return self._data
+
+    def load(self):
+        """Loads the workshop data (from the cache if it is up to date) and indexes it."""
+        with open(self.path, 'rb') as f:
+            raw = f.read()
+        cache = WorkshopData.CACHE.format(hashlib.sha1(raw).hexdigest())
         try:
-            with open('Workshop.json') as f:
-                self.data = json.load(f)
-        except FileNotFoundError:
-            with open('OWScript/Workshop.json') as f:
-                self.data = json.load(f)
+            with open(cache, 'rb') as f:
+                self._data = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            import json
+            self._data = json.loads(raw.decode('utf-8'))
+            self.save(cache)
+        self.index()
 
-    def _gettype(self, type_):
-        """Returns a WorkshopType object containing data about the argument."""
-        if type_ == 'ANY':
-            return Any
-        for key in self.data.get('types'):
-            if key.get('name') == type_:
-                name = type_.title().replace(' ', '')
-                return globals().get(name)
+    def save(self, cache):
+        """Writes the marshal cache; it is written to a temporary file first so that concurrent runs never read a partial one."""
+        temp = '{}.{}'.format(cache, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(cache), exist_ok=True)
+            with open(temp, 'wb') as f:
+                marshal.dump(self._data, f)
+            os.replace(temp, cache)
+        except OSError:
+            pass
 
-    def __getitem__(self, item):
-        """Returns the instance of the class from the specified Event/Action/Value."""
+    def index(self):
+        """Builds the name lookups of the events/actions/values and of the types."""
+        self.entries = {}
         for data_type, data_list in self.data.items():
             if data_type in ('events', 'types'):
                 continue
             for key in data_list:
-                if key.get('name') == item:
-                    name = item
-                    description = key.get('description')
-                    _args = key.get('args', [])
-                    if not _args:
-                        return Constant(name=item)
-                    args = [self._gettype(arg.get('type')) for arg in key.get('args', [])]
-                    node = OWID(name=name, description=description, args=args)
-                    return node
-        return Constant(name=item)
+                self.entries.setdefault(key.get('name'), key)
+        self.types = {}
+        for key in self.data.get('types'):
+            self.types.setdefault(key.get('name'), globals().get(key.get('name').title().replace(' ', '')))
+        self.types['ANY'] = Any
+        self.arg_types = {}
+
+    def _gettype(self, type_):
+        """Returns a WorkshopType object containing data about the argument."""
+        if self._data is None:
+            self.load()
+        return self.types.get(type_)
+
+    def __getitem__(self, item):
+        """Returns the instance of the class from the specified Event/Action/Value."""
+        if self._data is None:
+            self.load()
+        key = self.entries.get(item)
+        if key is None or not key.get('args'):
+            return Constant(name=item)
+        args = self.arg_types.get(item)
+        if args is None:
+            args = self.arg_types[item] = tuple(self._gettype(arg.get('type')) for arg in key.get('args'))
+        return OWID(name=item, description=key.get('description'), args=args)
 Workshop = WorkshopData()
 # types_ = Workshop.data.get('types')
 # print([x.get('name') for x in types_])